@@ -0,0 +1,238 @@
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+from leaflesiondetector import lesion_detector
+from leaflesiondetector.leaf import Leaf
+
+IMAGE_FOLDERS = ["demo_images", "tests/fixtures/input_images"]
+
+STAGES = [
+    "hsv",
+    "background_detector",
+    "append_reference_area_binary",
+    "append_leaf_area_binary",
+    "append_lesion_area_binary",
+    "process_image",
+]
+
+
+def synthetic_leaf(megapixels: float, seed: int = 0) -> Image.Image:
+    """
+    Draws a leaf with lesions and a pink reference square on a black background, at the given size.
+    """
+    rng = np.random.default_rng(seed)
+    width = int(math.sqrt(megapixels * 1e6 / 1.6))
+    height = int(width * 1.6)
+    rows, cols = np.ogrid[:height, :width]
+
+    img = np.full((height, width, 3), 12, dtype=np.uint8)
+    leaf = ((rows - height / 2) / (height * 0.42)) ** 2 + (
+        (cols - width / 2) / (width * 0.38)
+    ) ** 2 < 1
+    img[leaf] = (80, 170, 60)
+    for _ in range(60):
+        row, col = rng.uniform(0.2, 0.8) * height, rng.uniform(0.25, 0.75) * width
+        radius = rng.uniform(0.002, 0.03) * width
+        top, left = int(row - radius), int(col - radius)
+        box = (slice(top, int(row + radius) + 1), slice(left, int(col + radius) + 1))
+        lesion = (rows[box[0]] - row) ** 2 + (cols[:, box[1]] - col) ** 2 < radius**2
+        img[box][lesion & leaf[box]] = (120, 80, 30)
+    side = int(0.14 * width)
+    img[side // 4 : side // 4 + side, side // 4 : side // 4 + side] = (255, 0, 200)
+    noise = rng.integers(-6, 7, size=img.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(img + noise, 0, 255).astype(np.uint8))
+
+
+def load_images(folders: list, sizes: list) -> dict:
+    """
+    Returns the benchmark data sets, mapping a data set name to a list of (name, image) pairs.
+    Files that cannot be decoded, e.g. Git LFS pointers that were not fetched, are skipped.
+    """
+    datasets = {}
+    for folder in folders:
+        images = []
+        for file in sorted(Path(folder).glob("*")):
+            try:
+                with Image.open(file) as img:
+                    images.append((file.name, img.convert("RGB")))
+            except (UnidentifiedImageError, OSError):
+                print(f"Skipping {file}, it is not a valid image.", file=sys.stderr)
+        if images:
+            datasets[folder] = images
+    for size in sizes:
+        datasets[f"synthetic_{size:g}mp"] = [
+            (f"synthetic_{size:g}mp.png", synthetic_leaf(size))
+        ]
+    return datasets
+
+
+def new_leaf(name: str, img: Image.Image) -> Leaf:
+    leaf = Leaf(name, name, img, background_colour="Black")
+    leaf.minimum_lesion_area_value = lesion_detector.settings["Black"]["low_intensity"]
+    leaf.modified_image = img.copy()
+    return leaf
+
+
+def run_stages(name: str, img: Image.Image) -> dict:
+    """
+    Runs each stage once on a fresh leaf, in pipeline order, and returns the seconds taken by each.
+    The HSV conversion is timed on its own so that it is not charged to the first stage using it.
+    """
+    timings = {}
+
+    def timed(stage, function, *args):
+        start_time = time.perf_counter()
+        function(*args)
+        timings[stage] = time.perf_counter() - start_time
+
+    leaf = new_leaf(name, img)
+    timed("hsv", lambda: leaf.hsv)
+    timed("background_detector", lesion_detector.background_detector, leaf)
+    leaf.background_colour = "Black"
+    timed(
+        "append_reference_area_binary",
+        lesion_detector.append_reference_area_binary,
+        leaf,
+    )
+    timed("append_leaf_area_binary", lesion_detector.append_leaf_area_binary, leaf)
+    timed("append_lesion_area_binary", lesion_detector.append_lesion_area_binary, leaf)
+    timed("process_image", lesion_detector.process_image, new_leaf(name, img))
+    return timings
+
+
+def peak_memory(name: str, img: Image.Image) -> int:
+    """
+    Returns the peak bytes allocated while processing the image, measured with tracemalloc.
+    """
+    leaf = new_leaf(name, img)
+    tracemalloc.start()
+    try:
+        lesion_detector.process_image(leaf)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(datasets: dict, repeat: int) -> dict:
+    """
+    Benchmarks every stage on every data set. The median of the repeats is used for each image.
+    """
+    results = {}
+    for dataset, images in datasets.items():
+        seconds = {stage: 0.0 for stage in STAGES}
+        megapixels = sum(img.size[0] * img.size[1] for _, img in images) / 1e6
+        for name, img in images:
+            runs = [run_stages(name, img) for _ in range(repeat)]
+            for stage in STAGES:
+                seconds[stage] += statistics.median(run[stage] for run in runs)
+        memory = max(peak_memory(name, img) for name, img in images)
+
+        results[dataset] = {
+            stage: {
+                "images": len(images),
+                "megapixels": megapixels,
+                "seconds": seconds[stage],
+                "images_per_second": len(images) / seconds[stage],
+                "megapixels_per_second": megapixels / seconds[stage],
+            }
+            for stage in STAGES
+        }
+        results[dataset]["process_image"]["peak_memory"] = memory
+        print(
+            f"{dataset}: {len(images)} images, {megapixels:.1f} MP, "
+            f"{results[dataset]['process_image']['megapixels_per_second']:.2f} MP/s, "
+            f"peak {memory / 2**20:.0f} MiB"
+        )
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, max_ratio: float) -> list:
+    """
+    Compares the results with a baseline. Returns a message for every stage whose time per megapixel,
+    or peak memory, grew by more than max_ratio.
+    """
+    regressions = []
+    for dataset, stages in baseline.items():
+        for stage, expected in stages.items():
+            measured = results.get(dataset, {}).get(stage)
+            if measured is None:
+                continue
+            ratio = (
+                expected["megapixels_per_second"] / measured["megapixels_per_second"]
+            )
+            if ratio > max_ratio:
+                regressions.append(
+                    f"{dataset} {stage}: {ratio:.2f}x slower than the baseline"
+                )
+            if "peak_memory" in expected and "peak_memory" in measured:
+                ratio = measured["peak_memory"] / expected["peak_memory"]
+                if ratio > max_ratio:
+                    regressions.append(
+                        f"{dataset} {stage}: {ratio:.2f}x more memory than the baseline"
+                    )
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the lesion detection pipeline."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=float,
+        nargs="*",
+        default=[1, 12, 48],
+        help="megapixel sizes of the synthetic images (default: 1 12 48)",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", default="benchmark_results.json", help="JSON file for the results"
+    )
+    parser.add_argument(
+        "--baseline", help="JSON results of an earlier run to compare with"
+    )
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=1.5,
+        help="fail when a stage is this many times slower, or uses this many times more memory, than the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    results = benchmark(load_images(IMAGE_FOLDERS, args.sizes), args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "environment": {
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "machine": platform.machine(),
+                    "cpu_count": os.cpu_count(),
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = find_regressions(results, baseline, args.max_ratio)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
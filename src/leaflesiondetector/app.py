@@ -22,6 +22,9 @@ if "render" not in st.session_state:
 if "points" not in st.session_state:
     st.session_state["points"] = []
 
+if "refinements" not in st.session_state:
+    st.session_state["refinements"] = {}
+
 st.set_page_config(
     page_title="Leaf Lesion Detector", page_icon=":leaves:", layout="wide"
 )
@@ -42,6 +45,7 @@ def run_demo():
 
     if (len(uploaded_files) > 0) and submitted:
         st.session_state["leaves"] = LeafList()
+        st.session_state["refinements"] = {}
         st.session_state["maintain"] = False
         ui_functions.save_uploaded_files(
             uploaded_files, st.session_state["leaves"].leaves
@@ -59,9 +63,11 @@ with st.form("my-form", clear_on_submit=True):
     uploaded_files = st.file_uploader(
         "Upload images", type=["jpg", "jpeg", "png"], accept_multiple_files=True
     )
+    st.checkbox("Measure every leaf in an image separately", key="multi_leaf")
     submitted = st.form_submit_button("Process Images")
     if (len(uploaded_files) > 0) and submitted:
         st.session_state["leaves"] = LeafList()
+        st.session_state["refinements"] = {}
         st.session_state["maintain"] = False
         ui_functions.save_uploaded_files(
             uploaded_files, st.session_state["leaves"].leaves
@@ -84,4 +90,5 @@ if st.session_state["render"]:
     message.info("Loading images...")
     ui_functions.download_results(st.session_state["leaves"].leaves)
     ui_functions.display_results(st.session_state["leaves"].leaves)
+    ui_functions.store_results(st.session_state["leaves"])
     message.empty()
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from leaflesiondetector.config import PipelineConfig
+from leaflesiondetector.leaf import Leaf
+
+# Bump this whenever a change to the pipeline changes its results, so stale entries are never loaded
+CACHE_VERSION = 3
+
+METRIC_FIELDS = (
+    "reference",
+    "reference_area",
+    "leaf_area",
+    "lesion_area",
+    "lesion_area_percentage",
+    "lesion_area_mm2",
+    "average_lesion_size",
+    "num_lesions",
+    "min_lesion_size",
+    "max_lesion_size",
+    "lesion_size_threshold",
+)
+
+# The per label lesion features, if computed, are stored as an array per column with this prefix
+FEATURE_PREFIX = "label_feature_"
+
+
+class ResultCache:
+    """
+    A size bounded on-disk cache of process_image results, keyed by the image content and every setting
+    that affects the result. Each entry is a compressed .npz file holding the masks, the label arrays,
+    the overlay pixels and the metrics. The least recently used entries are evicted first.
+    """
+
+    def __init__(self, folder: str, max_size_mb: float):
+        self.folder = Path(folder)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def key(self, leaf: Leaf, config: PipelineConfig) -> str:
+        """
+        Returns the cache key of the leaf object's image and processing settings.
+        """
+        relevant = {
+            "version": CACHE_VERSION,
+            "image": leaf.content_hash,
+            "pixel_area": leaf.pixel_area,
+            "background_colour": leaf.background_colour,
+            "minimum_lesion_area_value": leaf.minimum_lesion_area_value,
+            "lesion_size_threshold": leaf.lesion_size_threshold,
+            "config": config.digest,
+        }
+        return hashlib.blake2b(
+            json.dumps(relevant, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
+
+    def load(self, leaf: Leaf, key: str) -> bool:
+        """
+        Restores the cached results for the key onto the leaf object. Returns False on a cache miss.
+        """
+        path = self.folder / f"{key}.npz"
+        try:
+            with np.load(path) as entry:
+                arrays = dict(entry)
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Missing, evicted by another process while being read, or truncated
+            return False
+
+        shape = arrays["labeled_pixels"].shape
+
+        for name, value in json.loads(arrays["metrics"].item()).items():
+            setattr(leaf, name, value)
+        leaf.lesion_class_map = {
+            int(k): v for k, v in json.loads(arrays["lesion_class_map"].item()).items()
+        }
+
+        leaf.reference_mask = (
+            _unpack_mask(arrays["reference_mask"], shape) if leaf.reference else None
+        )
+        leaf.leaf_mask = _unpack_mask(arrays["leaf_mask"], shape)
+        leaf.leaf_outline_mask = _unpack_mask(arrays["leaf_outline_mask"], shape)
+        leaf.lesion_binary = Image.fromarray(
+            _unpack_mask(arrays["lesion_binary"], shape)
+        ).convert("L")
+        leaf.labeled_pixels = arrays["labeled_pixels"]
+        leaf.label_sizes = arrays["label_sizes"]
+        leaf.label_slices = None
+        leaf.lesion_colors = arrays["lesion_colors"]
+        features = {
+            name[len(FEATURE_PREFIX) :]: array
+            for name, array in arrays.items()
+            if name.startswith(FEATURE_PREFIX)
+        }
+        leaf.label_features = features or None
+
+        outlined = np.array(leaf.img.convert(arrays["mode"].item()))
+        outlined[_unpack_mask(arrays["outline_mask"], shape)] = arrays["outline_pixels"]
+        leaf.outlined_image = Image.fromarray(outlined)
+        outlined[_unpack_mask(arrays["lesion_mask"], shape)] = arrays["lesion_pixels"]
+        leaf.modified_image = Image.fromarray(outlined)
+        return True
+
+    def store(self, leaf: Leaf, key: str) -> None:
+        """
+        Saves the results of the processed leaf object under the key and evicts the least recently used
+        entries until the cache fits in its size limit. The overlays are stored as the pixels that differ
+        from the image they were drawn on, instead of whole images.
+        """
+        mode = leaf.modified_image.mode
+        img = np.asarray(leaf.img if leaf.img.mode == mode else leaf.img.convert(mode))
+        outlined = np.asarray(leaf.outlined_image)
+        modified = np.asarray(leaf.modified_image)
+        outline_mask = _changed_pixels(outlined, img)
+        lesion_mask = _changed_pixels(modified, outlined)
+
+        arrays = {
+            "metrics": np.array(
+                json.dumps(
+                    {name: getattr(leaf, name) for name in METRIC_FIELDS},
+                    default=lambda value: value.item(),
+                )
+            ),
+            "lesion_class_map": np.array(json.dumps(leaf.lesion_class_map)),
+            "mode": np.array(mode),
+            "leaf_mask": np.packbits(leaf.leaf_mask),
+            "leaf_outline_mask": np.packbits(leaf.leaf_outline_mask),
+            "lesion_binary": np.packbits(np.asarray(leaf.lesion_binary) > 0),
+            "labeled_pixels": leaf.labeled_pixels,
+            "label_sizes": leaf.label_sizes,
+            "lesion_colors": leaf.lesion_colors,
+            "outline_mask": np.packbits(outline_mask),
+            "outline_pixels": outlined[outline_mask],
+            "lesion_mask": np.packbits(lesion_mask),
+            "lesion_pixels": modified[lesion_mask],
+        }
+        for name, array in (leaf.label_features or {}).items():
+            arrays[FEATURE_PREFIX + name] = array
+        if leaf.reference:
+            arrays["reference_mask"] = np.packbits(leaf.reference_mask)
+
+        # Write to a temporary file unique to this call first, so other threads and processes never read a partial
+        # entry or write to the same file. This is np.savez_compressed with a faster compression level.
+        with tempfile.NamedTemporaryFile(
+            dir=self.folder, prefix=f"{key}.", suffix=".tmp", delete=False
+        ) as temporary_file:
+            with zipfile.ZipFile(
+                temporary_file, "w", zipfile.ZIP_DEFLATED, compresslevel=1
+            ) as archive:
+                for name, array in arrays.items():
+                    with archive.open(f"{name}.npy", "w", force_zip64=True) as entry:
+                        np.lib.format.write_array(entry, array)
+        try:
+            os.replace(temporary_file.name, self.folder / f"{key}.npz")
+        except OSError:
+            # Not caching a result is never fatal, it is computed again on the next miss
+            Path(temporary_file.name).unlink(missing_ok=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache fits in its size limit.
+        """
+        entries = []
+        for path in self.folder.glob("*.npz"):
+            try:
+                entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except FileNotFoundError:
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+
+def _changed_pixels(image: np.ndarray, original: np.ndarray) -> np.ndarray:
+    """
+    Returns a mask of the pixels where two image arrays differ in any channel.
+    """
+    changed = image != original
+    return changed.any(axis=2) if changed.ndim == 3 else changed
+
+
+def _unpack_mask(packed: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    Returns the boolean mask of the given shape that was packed with np.packbits.
+    """
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).view(bool)
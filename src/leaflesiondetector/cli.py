@@ -0,0 +1,186 @@
+import argparse
+import dataclasses
+import glob
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from PIL import UnidentifiedImageError
+from leaflesiondetector import ingest, lesion_detector
+from leaflesiondetector.cache import ResultCache
+from leaflesiondetector.config import PipelineConfig
+from leaflesiondetector.leaf import LeafMetrics
+from leaflesiondetector.results import ResultsWriter, encode_leaf_images
+from leaflesiondetector.store import ResultsStore
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def find_images(paths: list) -> list:
+    """
+    This function expands directories and glob patterns into a list of image files.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = [
+                str(file)
+                for file in Path(path).iterdir()
+                if file.suffix.lower() in IMAGE_EXTENSIONS
+            ]
+        else:
+            matches = glob.glob(path)
+        files.extend(file for file in sorted(matches) if file not in files)
+    return files
+
+
+def process_file(
+    file: str,
+    save_images: bool = False,
+    cache_folder: str = None,
+    multi_leaf: bool = False,
+    config: PipelineConfig = None,
+) -> tuple:
+    """
+    This function processes a single image file in a worker process. Returns an (error, results) pair, where results
+    holds a (metrics record, encoded images) pair for each leaf, with the images only if requested, so the full
+    resolution arrays never leave the worker. If the file is not a valid image, holds no leaf or fails to process,
+    error describes why and results is empty, so one bad file never stops the batch. Results are looked up in and added to the on-disk
+    cache in cache_folder, if given. With multi_leaf, every leaf in the image is measured separately.
+    The leaves are processed with the config, if given, otherwise with the module settings.
+    """
+    try:
+        leaf = ingest.load_leaf(file)
+    except (UnidentifiedImageError, OSError):
+        return "not a valid image", []
+
+    cache = (
+        ResultCache(cache_folder, lesion_detector.settings["cache_max_size_mb"])
+        if cache_folder is not None
+        else None
+    )
+    try:
+        leaves = lesion_detector.measure_leaves(leaf, multi_leaf, cache, config)
+        if len(leaves) == 0:
+            return "no leaf found", []
+        return None, [
+            (
+                LeafMetrics.from_leaf(leaf),
+                encode_leaf_images(leaf) if save_images else {},
+            )
+            for leaf in leaves
+        ]
+    except Exception as error:
+        return f"could not be processed ({type(error).__name__}: {error})", []
+
+
+def main(argv: list = None) -> None:
+    """
+    This function runs the lesion detector on a batch of images from the command line.
+    """
+    parser = argparse.ArgumentParser(
+        prog="leaflesiondetector",
+        description="Calculate the percentage of leaf area affected by disease for a batch of images.",
+    )
+    parser.add_argument(
+        "images", nargs="+", help="image files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=lesion_detector.settings["output_folder_path"],
+        help="folder or .zip archive to write results.csv and the images to",
+    )
+    parser.add_argument(
+        "--save-images",
+        action="store_true",
+        help="also save the modified image and binaries of every leaf",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: number of cores)",
+    )
+    parser.add_argument(
+        "--multi-leaf",
+        action="store_true",
+        help="measure every leaf in an image separately, e.g. for scanned trays",
+    )
+    parser.add_argument(
+        "--lesion-features",
+        action="store_true",
+        help="also write the position, shape and hue of every lesion to lesions.csv",
+    )
+    parser.add_argument(
+        "--cache",
+        default=lesion_detector.settings["cache_folder_path"],
+        help="folder of the on-disk cache of processed images",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="process every image without reading or writing the cache",
+    )
+    parser.add_argument(
+        "--store",
+        default=lesion_detector.settings["results_store_path"],
+        help="SQLite file the measurements of every batch are saved to, for the Visualization page",
+    )
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="do not save the measurements to the results store",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="also record the peak memory of each stage in profile.json (slower)",
+    )
+    args = parser.parse_args(argv)
+
+    files = find_images(args.images)
+    if len(files) == 0:
+        parser.error("no images found")
+
+    config = PipelineConfig.from_settings(lesion_detector.settings)
+    if args.lesion_features:
+        config = dataclasses.replace(config, lesion_features=True)
+
+    start_time = time.time()
+    with ResultsWriter(args.output, save_images=args.save_images) as writer:
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=tracemalloc.start if args.profile_memory else None,
+        ) as executor:
+            results = executor.map(
+                partial(
+                    process_file,
+                    save_images=args.save_images,
+                    cache_folder=None if args.no_cache else args.cache,
+                    multi_leaf=args.multi_leaf,
+                    config=config,
+                ),
+                files,
+            )
+            for i, (file, (error, leaves)) in enumerate(zip(files, results)):
+                if error is not None:
+                    print(f"{file}: {error}.", file=sys.stderr)
+                    continue
+                for record, images in leaves:
+                    writer.write(record, images)
+                    print(
+                        f"[{i + 1}/{len(files)}] {record.name}: {'%.2f'%record.lesion_area_percentage} %"
+                    )
+    if not args.no_store:
+        ResultsStore(args.store).save(writer.records)
+
+    print(f"Total run time: {'%.2f'%(time.time() - start_time)} seconds")
+
+
+if __name__ == "__main__":
+    main()
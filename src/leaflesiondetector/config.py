@@ -0,0 +1,189 @@
+import copy
+import dataclasses
+import hashlib
+import json
+import os
+from collections.abc import Mapping, MutableMapping
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from importlib import resources
+
+# Environment variable naming a settings file to use instead of the one shipped with the package.
+# It is inherited by worker processes, so a whole batch job can be pointed at other settings.
+SETTINGS_ENV_VAR = "LEAFLESIONDETECTOR_SETTINGS"
+
+
+def load_settings(path: str = None) -> dict:
+    """
+    Returns the settings read from the JSON file at path, or from the file named by the LEAFLESIONDETECTOR_SETTINGS
+    environment variable, or from the settings.json shipped with the package. Each file is only read once,
+    and every call returns a new copy that can be changed without affecting other callers.
+    """
+    path = path or os.environ.get(SETTINGS_ENV_VAR)
+    return copy.deepcopy(_read_settings(str(path) if path else None))
+
+
+@lru_cache(maxsize=None)
+def _read_settings(path: str) -> dict:
+    """
+    Reads and parses a settings file, or the package settings if path is None.
+    """
+    if path is None:
+        text = (
+            resources.files("leaflesiondetector")
+            .joinpath("settings.json")
+            .read_text(encoding="utf-8")
+        )
+    else:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+    return json.loads(text)
+
+
+class LazySettings(MutableMapping):
+    """
+    A settings dict that is loaded with load_settings on first use, so importing a module that holds one reads no file.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self._settings = None
+        self._config = None
+
+    @property
+    def settings(self) -> dict:
+        if self._settings is None:
+            self._settings = load_settings(self.path)
+        return self._settings
+
+    def reload(self, path: str = None) -> None:
+        """
+        Replaces the settings with the ones read from path, or the default settings if path is None.
+        """
+        self.path = path
+        self._settings = None
+        self._config = None
+
+    def config(self) -> "PipelineConfig":
+        """
+        Returns the PipelineConfig built from the settings. It is built once, and again only after a setting is set,
+        deleted or reloaded. Changing a value nested in a setting, e.g. settings["Black"]["low_intensity"], is not
+        noticed, so set the whole setting instead.
+        """
+        if self._config is None:
+            self._config = PipelineConfig.from_settings(self)
+        return self._config
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __setitem__(self, key, value):
+        self.settings[key] = value
+        self._config = None
+
+    def __delitem__(self, key):
+        del self.settings[key]
+        self._config = None
+
+    def __iter__(self):
+        return iter(self.settings)
+
+    def __len__(self):
+        return len(self.settings)
+
+    def __repr__(self):
+        return f"LazySettings({self.settings!r})"
+
+
+@dataclass(frozen=True)
+class ColourRange:
+    """
+    The HSV bounds of a class of pixels, e.g. leaf tissue, and the contour level used to trace its boundary.
+    """
+
+    min_hue: int
+    max_hue: int
+    min_saturation: int
+    max_saturation: int
+    min_value: int
+    max_value: int
+    level: int = None
+
+
+@dataclass(frozen=True)
+class BackgroundThresholds:
+    """
+    The thresholds used for the images taken on one background colour.
+    """
+
+    low_intensity: int
+    high_intensity: int
+    leaf_area: ColourRange
+    lesion_area: ColourRange
+    reference_area: ColourRange
+
+    @classmethod
+    def from_settings(cls, thresholds: Mapping) -> "BackgroundThresholds":
+        return cls(
+            low_intensity=thresholds["low_intensity"],
+            high_intensity=thresholds["high_intensity"],
+            leaf_area=ColourRange(**thresholds["leaf_area"]),
+            lesion_area=ColourRange(**thresholds["lesion_area"]),
+            reference_area=ColourRange(**thresholds["reference_area"]),
+        )
+
+
+@dataclass(frozen=True)
+class PipelineConfig:
+    """
+    The settings that affect how an image is processed, as an immutable and hashable object. Each leaf can be
+    processed with its own config, so images with different settings can share a batch or a worker pool.
+    """
+
+    black: BackgroundThresholds
+    white: BackgroundThresholds
+    reference_area_mm: float
+    leaf_segmentation: str = "contour"
+    leaf_blur_size: int = 13
+    lesion_blur_size: int = 1
+    reference_blur_size: int = 25
+    tile_rows: int = 0
+    min_leaf_area_fraction: float = 0.1
+    lesion_features: bool = False
+
+    @classmethod
+    def from_settings(cls, settings: Mapping = None) -> "PipelineConfig":
+        """
+        Builds the config from a settings dict, or from the settings returned by load_settings if none is given.
+        """
+        settings = load_settings() if settings is None else settings
+        return cls(
+            black=BackgroundThresholds.from_settings(settings["Black"]),
+            white=BackgroundThresholds.from_settings(settings["White"]),
+            reference_area_mm=settings["reference_area_mm"],
+            leaf_segmentation=settings["leaf_segmentation"],
+            leaf_blur_size=settings["median_blur_size"]["leaf"],
+            lesion_blur_size=settings["median_blur_size"]["lesion"],
+            reference_blur_size=settings["median_blur_size"]["reference"],
+            tile_rows=settings["tile_rows"],
+            min_leaf_area_fraction=settings["min_leaf_area_fraction"],
+            lesion_features=settings["lesion_features"],
+        )
+
+    def thresholds(self, background_colour: str) -> BackgroundThresholds:
+        """
+        Returns the thresholds for images on the given background colour, "Black" or "White".
+        """
+        return {"Black": self.black, "White": self.white}[background_colour]
+
+    @cached_property
+    def digest(self) -> str:
+        """
+        A hash of every field that can change the results, stable across processes unlike hash().
+        tile_rows is left out, as the tiled and the single pass results are identical.
+        """
+        fields = dataclasses.asdict(self)
+        del fields["tile_rows"]
+        return hashlib.blake2b(
+            json.dumps(fields, sort_keys=True).encode(), digest_size=16
+        ).hexdigest()
@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import Executor
+from pathlib import Path
+from PIL import Image, ImageOps, UnidentifiedImageError
+from leaflesiondetector.leaf import Leaf
+
+
+def file_name(file) -> str:
+    """
+    Returns the file name of a path or of a file-like object with a name, e.g. a Streamlit upload.
+    """
+    return Path(getattr(file, "name", file)).name
+
+
+def decode_image(image: Image.Image) -> Image.Image:
+    """
+    Decodes an opened image and turns it upright according to its EXIF orientation.
+    """
+    image.load()
+    ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+def load_leaf(file) -> Leaf:
+    """
+    Reads an image file, a path or a file-like object, into a new leaf object, keeping its DPI if it has one.
+    Raises UnidentifiedImageError or OSError if the file is not a valid image.
+    """
+    name = file_name(file)
+    # Image.open only parses the header, the pixels are decoded once by decode_image
+    with Image.open(file) as image:
+        dpi = image.info.get("dpi")
+        img = decode_image(image)
+    return Leaf(f"{name}_{int(time.time_ns())}", name, img, dpi=dpi)
+
+
+def load_leaves(files: list, executor: Executor) -> tuple:
+    """
+    Reads image files into leaf objects, decoding them in parallel on the executor.
+    Returns the leaf objects in the order of the files, and the names of the files that are not valid images.
+    """
+    futures = [executor.submit(load_leaf, file) for file in files]
+    leaves, invalid_files = [], []
+    for file, future in zip(files, futures):
+        try:
+            leaves.append(future.result())
+        except (UnidentifiedImageError, OSError):
+            invalid_files.append(file_name(file))
+    return leaves, invalid_files
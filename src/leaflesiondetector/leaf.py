@@ -1,6 +1,22 @@
+import hashlib
+import uuid
 from typing import List
+import numpy as np
 from PIL import Image
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
+from leaflesiondetector.config import PipelineConfig
+
+
+@dataclass
+class LesionEdit:
+    """
+    A lesion removed by clicking on it, stored as the clicked point and the label's size
+    instead of a copy of the image.
+    """
+
+    point: tuple[int, int]
+    class_value: int
+    size: float
 
 
 @dataclass
@@ -11,10 +27,10 @@ class Leaf:
     reference: bool = False
     reference_area: float = 0
     background_colour: str = ""
-    leaf_binary: Image = None
-    leaf_outline_binary: Image = None
+    leaf_mask: np.ndarray = None
+    leaf_outline_mask: np.ndarray = None
     lesion_binary: Image = None
-    reference_binary: Image = None
+    reference_mask: np.ndarray = None
     leaf_area: int = 0
     lesion_area: int = 0
     lesion_area_percentage: float = 0
@@ -26,9 +42,194 @@ class Leaf:
     num_lesions: int = 0
     min_lesion_size: float = 0
     max_lesion_size: float = 0
-    labeled_pixels: list = field(default_factory=list)
+    labeled_pixels: np.ndarray = None
     lesion_class_map: dict = field(default_factory=dict)
     lesion_size_threshold: float = 0.01
+    label_sizes: np.ndarray = None
+    label_slices: list = None
+    lesion_colors: np.ndarray = None
+    label_features: dict = None
+    lesion_values: np.ndarray = None
+    lesion_boundary: np.ndarray = None
+    edits: List[LesionEdit] = field(default_factory=list)
+    undone_edits: List[LesionEdit] = field(default_factory=list)
+    stage_inputs: dict = field(default_factory=dict)
+    profile: dict = field(default_factory=dict)
+    pixel_area: int = 1
+    bbox: tuple = None
+    dpi: tuple = None
+    config: PipelineConfig = field(default=None, repr=False)
+    preview: "Leaf" = field(default=None, repr=False, compare=False)
+    _hsv: np.ndarray = field(default=None, init=False, repr=False, compare=False)
+    _content_hash: str = field(default=None, init=False, repr=False, compare=False)
+    _outlined_image: Image = field(default=None, init=False, repr=False, compare=False)
+    _outline_overlay: tuple = field(default=None, init=False, repr=False, compare=False)
+
+    def __setattr__(self, name, value):
+        # Drop the cached HSV conversion, content hash, stage results and preview whenever the source image is replaced
+        if name == "img":
+            object.__setattr__(self, "_hsv", None)
+            object.__setattr__(self, "_content_hash", None)
+            object.__setattr__(self, "_outline_overlay", None)
+            object.__setattr__(self, "stage_inputs", {})
+            object.__setattr__(self, "preview", None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def outlined_image(self) -> Image:
+        """
+        The image with the reference and leaf outline marked, which the lesions are painted on.
+        After drop_caches it is kept as the pixels it changes in img, and rebuilt on first use.
+        """
+        if self._outlined_image is None and self._outline_overlay is not None:
+            mode, packed, pixels = self._outline_overlay
+            outlined = np.array(self.img.convert(mode))
+            changed = np.unpackbits(packed, count=outlined.shape[0] * outlined.shape[1])
+            outlined[changed.reshape(outlined.shape[:2]).view(bool)] = pixels
+            self._outlined_image = Image.fromarray(outlined)
+            self._outline_overlay = None
+        return self._outlined_image
+
+    @outlined_image.setter
+    def outlined_image(self, value: Image) -> None:
+        object.__setattr__(self, "_outlined_image", value)
+        object.__setattr__(self, "_outline_overlay", None)
+
+    @property
+    def hsv(self) -> np.ndarray:
+        """
+        The image converted to HSV as a read-only uint8 array. It is computed on first
+        use and shared by every stage of the pipeline until img changes.
+        """
+        if self._hsv is None:
+            hsv = np.array(self.img.convert("HSV"))
+            hsv.flags.writeable = False
+            self._hsv = hsv
+        return self._hsv
+
+    @property
+    def content_hash(self) -> str:
+        """
+        A hash of the image's mode, size and pixels, computed on first use until img changes.
+        """
+        if self._content_hash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(f"{self.img.mode} {self.img.size}".encode())
+            digest.update(self.img.tobytes())
+            self._content_hash = digest.hexdigest()
+        return self._content_hash
+
+    # The masks are stored as boolean arrays and only made into black and white images for export or display
+    @property
+    def leaf_binary(self) -> Image:
+        return _mask_image(self.leaf_mask)
+
+    @property
+    def leaf_outline_binary(self) -> Image:
+        return _mask_image(self.leaf_outline_mask)
+
+    @property
+    def reference_binary(self) -> Image:
+        return _mask_image(self.reference_mask)
+
+    @property
+    def lesion_features(self) -> dict:
+        """
+        The features of the current lesions, as a dict of column name to array with a row per lesion in label order,
+        or None if they were not computed. Lesions removed by clicking on them are left out.
+        """
+        if self.label_features is None:
+            return None
+        labels = np.array(sorted(self.lesion_class_map), dtype=np.int64)
+        return {
+            "label": labels,
+            **{name: column[labels] for name, column in self.label_features.items()},
+        }
+
+    def drop_caches(self) -> None:
+        """
+        Drops the HSV conversion and the lesion values, which the pipeline recomputes on first use, and keeps the
+        outlined image as the pixels it changes in img. Used before a processed leaf is returned from a worker
+        process or kept in a session. The leaf boundary of a leaf cropped from a tray is kept, as only the tray
+        can reproduce it.
+        """
+        object.__setattr__(self, "_hsv", None)
+        self.lesion_values = None
+        if self.bbox is None:
+            self.lesion_boundary = None
+        if self._outlined_image is not None:
+            mode = self._outlined_image.mode
+            img = np.asarray(
+                self.img if self.img.mode == mode else self.img.convert(mode)
+            )
+            outlined = np.asarray(self._outlined_image)
+            changed = img != outlined
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            self._outline_overlay = (mode, np.packbits(changed), outlined[changed])
+            self._outlined_image = None
+
+    def release_images(self) -> None:
+        """
+        Drops the images and arrays held by the leaf, keeping only its measurements.
+        """
+        for name in (
+            "img",
+            "modified_image",
+            "outlined_image",
+            "leaf_mask",
+            "leaf_outline_mask",
+            "lesion_binary",
+            "reference_mask",
+            "labeled_pixels",
+            "label_sizes",
+            "label_slices",
+            "lesion_colors",
+            "label_features",
+            "lesion_values",
+            "lesion_boundary",
+        ):
+            setattr(self, name, None)
+
+    def __lt__(self, other):
+        return self.lesion_area_percentage < other.lesion_area_percentage
+
+
+def _mask_image(mask: np.ndarray) -> Image:
+    """
+    Returns a boolean mask as a black and white RGB image, or None if there is no mask.
+    """
+    return None if mask is None else Image.fromarray(mask).convert("RGB")
+
+
+@dataclass
+class LeafMetrics:
+    """
+    The measurements of a processed leaf without any of its images.
+    """
+
+    name: str
+    reference: bool
+    background_colour: str
+    leaf_area: float
+    lesion_area: float
+    lesion_area_percentage: float
+    run_time: float
+    minimum_lesion_area_value: int
+    lesion_size_threshold: float
+    average_lesion_size: float
+    num_lesions: int
+    min_lesion_size: float
+    max_lesion_size: float
+    lesion_class_map: dict
+    profile: dict
+    bbox: tuple
+    lesion_features: dict
+    content_hash: str
+
+    @classmethod
+    def from_leaf(cls, leaf: Leaf) -> "LeafMetrics":
+        return cls(**{f.name: getattr(leaf, f.name) for f in fields(cls)})
 
     def __lt__(self, other):
         return self.lesion_area_percentage < other.lesion_area_percentage
@@ -37,3 +238,5 @@ class Leaf:
 @dataclass
 class LeafList:
     leaves: List[Leaf] = field(default_factory=list)
+    # The id the leaves are saved under in the results store, a new one for every upload
+    batch: str = field(default_factory=lambda: uuid.uuid4().hex)
@@ -1,167 +1,639 @@
 import numpy as np
 from PIL import Image, ImageDraw, ImageEnhance
-from PIL import ImageFilter
-import json
+import copy
+import dataclasses
+import math
+from pathlib import Path
 import time
-from leaflesiondetector.leaf import Leaf
+from leaflesiondetector.leaf import Leaf, LesionEdit
+from leaflesiondetector.cache import ResultCache
+from leaflesiondetector.config import LazySettings, PipelineConfig
+from leaflesiondetector.profiling import profile_stage
 from skimage import measure
 from scipy import ndimage
 
-with open("src/leaflesiondetector/settings.json") as f:
-    settings = json.load(f)
+# The settings used for leaves without a config of their own
+settings = LazySettings()
 
+# The leaf attributes each stage of process_image depends on, in pipeline order.
+# Replacing leaf.img clears the cached inputs, so every stage reruns on a new image.
+STAGE_INPUTS = {
+    "leaf_area": ("background_colour", "config"),
+    "lesion_area": ("minimum_lesion_area_value",),
+    "lesion_filter": ("lesion_size_threshold",),
+}
 
+
+@profile_stage
 def background_detector(leaf: Leaf):
-    hsv_img = leaf.img.convert("HSV")
-    hsv = np.array(hsv_img)
-    value = hsv[:, :, 2] < 70
+    value = threshold_mask(leaf, _dark_threshold)
 
-    if np.sum(value) > (hsv.shape[0] * hsv.shape[1] * 0.4):
+    if np.sum(value) > (value.shape[0] * value.shape[1] * 0.4):
         leaf.background_colour = "Black"
     else:
         leaf.background_colour = "White"
 
 
-def value_to_color(value, vmin, vmax):
-    """Convert a value to an RGB color tuple based on its position between vmin and vmax."""
+def values_to_colors(values: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    """
+    Converts an array of values to RGB colors from red at vmax to yellow at vmin. All values are black when vmin == vmax.
+    """
+    colors = np.zeros((len(values), 3), dtype=np.uint8)
     vrange = vmax - vmin
-    if vrange == 0:
-        return (0, 0, 0)
-    else:
-        v = (value - vmin) / vrange
-        return (255, int(255 * (1.0 - v)), 0)
+    if vrange != 0:
+        colors[:, 0] = 255
+        colors[:, 1] = 255 * (1.0 - (values - vmin) / vrange)
+    return colors
+
+
+def pipeline_config(leaf: Leaf) -> PipelineConfig:
+    """
+    Returns the config the leaf object is processed with: its own, or else the one built from the module settings.
+    """
+    if leaf.config is not None:
+        return leaf.config
+    return settings.config()
+
+
+def scaled_length(length: int, leaf: Leaf) -> int:
+    """
+    Converts a length in full resolution pixels, e.g. a filter size or line width, to pixels of the leaf image.
+    """
+    return max(1, math.ceil(length / leaf.pixel_area**0.5))
+
+
+def box_counts(mask: np.ndarray, size: int) -> np.ndarray:
+    """
+    Counts the set pixels of a boolean mask in the size x size neighbourhood of every pixel.
+    The mask is extended by repeating its edge pixels, like PIL's rank filters.
+    """
+    pad = size // 2
+    counts = np.pad(mask, pad, mode="edge").astype(np.int32)
+    counts = np.pad(counts.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    return (
+        counts[size:, size:]
+        - counts[:-size, size:]
+        - counts[size:, :-size]
+        + counts[:-size, :-size]
+    )
 
 
+def median_filter_mask(mask: np.ndarray, size: int) -> np.ndarray:
+    """
+    Applies a median filter to a boolean mask. A pixel is set when the majority of its
+    size x size neighbourhood is set, which matches PIL's MedianFilter on a 0/255 image.
+    """
+    return box_counts(mask, size) >= size * size - size * size // 2
+
+
+def boundary_band(region: np.ndarray, size: int) -> np.ndarray:
+    """
+    Returns the pixels whose size x size neighbourhood contains both region and non region pixels,
+    i.e. a band about size pixels wide centred on the boundary of the region.
+    """
+    counts = box_counts(region, size)
+    return (counts > 0) & (counts < size * size)
+
+
+def tiling_enabled(height: int, tile_rows: int) -> bool:
+    """
+    Returns whether an image of the given height is processed in strips of tile_rows rows.
+    A tile_rows of 0 processes every image in a single pass.
+    """
+    return 0 < tile_rows < height
+
+
+def row_tiles(height: int, tile_rows: int, halo: int = 0):
+    """
+    Yields the (top, bottom, start, stop) rows of each strip of an image of the given height, where start and stop
+    extend the strip by up to halo rows on either side. Without tiling, the whole image is a single strip.
+    """
+    tile_rows = tile_rows if tiling_enabled(height, tile_rows) else height
+    for top in range(0, height, tile_rows):
+        bottom = min(top + tile_rows, height)
+        yield top, bottom, max(0, top - halo), min(height, bottom + halo)
+
+
+def threshold_mask(leaf: Leaf, threshold, dtype=bool) -> np.ndarray:
+    """
+    Applies a threshold function, which takes an HSV array, the leaf object and its config, to the leaf image and
+    returns the mask. With tiling enabled, each strip is converted to HSV on its own, so the full HSV array is never
+    held. Functions returning another per-pixel array than a mask pass its dtype.
+    """
+    config = pipeline_config(leaf)
+    width, height = leaf.img.size
+    if not tiling_enabled(height, config.tile_rows):
+        return threshold(leaf.hsv, leaf, config)
+    mask = np.empty((height, width), dtype=dtype)
+    for top, bottom, _, _ in row_tiles(height, config.tile_rows):
+        hsv = np.asarray(leaf.img.crop((0, top, width, bottom)).convert("HSV"))
+        mask[top:bottom] = threshold(hsv, leaf, config)
+    return mask
+
+
+def apply_in_tiles(function, mask: np.ndarray, size: int, tile_rows: int) -> np.ndarray:
+    """
+    Applies a size x size neighbourhood function on boolean masks, e.g. median_filter_mask, in strips of tile_rows.
+    Each strip is extended by size // 2 rows on either side, so the result matches a single full image pass.
+    """
+    if not tiling_enabled(mask.shape[0], tile_rows):
+        return function(mask, size)
+    result = np.empty(mask.shape, dtype=bool)
+    for top, bottom, start, stop in row_tiles(mask.shape[0], tile_rows, size // 2):
+        result[top:bottom] = function(mask[start:stop], size)[
+            top - start : bottom - start
+        ]
+    return result
+
+
+def label_mask(mask: np.ndarray, tile_rows: int) -> tuple:
+    """
+    Labels the connected regions of a boolean mask and returns the labels and their number, like ndimage.label.
+    With tiling enabled, each strip is labeled on its own and the regions touching across a seam are merged.
+    Merged regions keep the smallest label, so the labels are numbered in the same raster order as ndimage.label.
+    """
+    height = mask.shape[0]
+    if not tiling_enabled(height, tile_rows):
+        return ndimage.label(mask)
+
+    # Label each strip, offsetting the labels past those of the strips above
+    labeled = np.empty(mask.shape, dtype=np.int32)
+    num_labels = 0
+    seams = []
+    for top, bottom, _, _ in row_tiles(height, tile_rows):
+        strip = labeled[top:bottom]
+        num_strip_labels = ndimage.label(mask[top:bottom], output=strip)
+        strip[strip > 0] += num_labels
+        num_labels += num_strip_labels
+        if top > 0:
+            above, below = labeled[top - 1], labeled[top]
+            touching = (above > 0) & (below > 0)
+            seams.append(np.stack([above[touching], below[touching]]))
+
+    # Merge the labels touching across the seams and renumber them consecutively.
+    # scipy.sparse is only imported here, as most images are labeled in one pass.
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    seams = np.concatenate(seams, axis=1)
+    graph = coo_matrix(
+        (np.ones(seams.shape[1]), (seams[0], seams[1])),
+        shape=(num_labels + 1, num_labels + 1),
+    )
+    num_regions, region = connected_components(graph, directed=False)
+    smallest_label = np.full(num_regions, num_labels + 1)
+    np.minimum.at(smallest_label, region, np.arange(num_labels + 1))
+    kept_labels = np.unique(smallest_label)
+    relabel = np.searchsorted(kept_labels, smallest_label[region]).astype(np.int32)
+    for top, bottom, _, _ in row_tiles(height, tile_rows):
+        labeled[top:bottom] = relabel[labeled[top:bottom]]
+    return labeled, len(kept_labels) - 1
+
+
+@profile_stage
 def segment_lesions(leaf: Leaf):
     """
     This function segments the lesions in the image.
     """
+    label_lesions(leaf)
+    filter_lesions(leaf)
+
+
+def label_lesions(leaf: Leaf) -> None:
+    """
+    Takes a leaf object as input and saves the labeled lesion regions and the size of each label, to the object.
+    """
 
     # Segment individual regions from the binary
-    lesion_binary = np.asarray(leaf.lesion_binary)
-    lesion_binary = ~lesion_binary
-    labeled, num_objects = ndimage.label(lesion_binary)
+    config = pipeline_config(leaf)
+    labeled, num_objects = label_mask(
+        np.asarray(leaf.lesion_binary) != 255, config.tile_rows
+    )
+
+    # Store the labels in the smallest integer type that holds them
+    leaf.labeled_pixels = labeled.astype(np.min_scalar_type(num_objects))
+    leaf.label_sizes = np.zeros(num_objects + 1, dtype=np.int64)
+    moments = np.zeros((7, num_objects + 1)) if config.lesion_features else None
+    for top, bottom, _, _ in row_tiles(labeled.shape[0], config.tile_rows):
+        leaf.label_sizes += np.bincount(
+            labeled[top:bottom].ravel(), minlength=num_objects + 1
+        )
+        if moments is not None:
+            moments += _label_moments(leaf, labeled, top, bottom, num_objects + 1)
+    leaf.label_slices = None
+    leaf.label_features = (
+        _label_features(leaf, moments) if moments is not None else None
+    )
+
+
+def _label_moments(
+    leaf: Leaf, labeled: np.ndarray, top: int, bottom: int, minlength: int
+) -> np.ndarray:
+    """
+    Returns the sums over each label's pixels in the rows top to bottom of the x and y coordinates, their squares,
+    their product and the hue, and the number of pixel edges between the label and other labels or the image border.
+    """
+    height, width = labeled.shape
+    strip = labeled[top:bottom]
+    labels = strip.ravel()
+    xs = np.arange(width, dtype=np.float64)
+    ys = np.arange(top, bottom, dtype=np.float64)[:, None]
+
+    # With tiling enabled only the strip is converted to HSV, like threshold_mask does
+    if tiling_enabled(height, pipeline_config(leaf).tile_rows):
+        strip_image = leaf.img.crop((0, top, width, bottom)).convert("HSV")
+        hue = np.asarray(strip_image.getchannel(0))
+    else:
+        hue = leaf.hsv[top:bottom, :, 0]
+
+    def sums(weights):
+        return np.bincount(
+            labels, np.broadcast_to(weights, strip.shape).ravel(), minlength
+        )
+
+    # Count the edges between horizontally and vertically adjacent pixels of different labels, on both sides
+    edges = np.zeros(minlength)
+    first = max(top, 1)
+    pairs = [
+        (strip[:, :-1], strip[:, 1:]),
+        (labeled[first - 1 : bottom - 1], labeled[first:bottom]),
+    ]
+    for before, after in pairs:
+        different = before != after
+        edges += np.bincount(before[different], minlength=minlength)
+        edges += np.bincount(after[different], minlength=minlength)
+    border = [strip[:, 0], strip[:, -1]]
+    if top == 0:
+        border.append(strip[0])
+    if bottom == height:
+        border.append(strip[-1])
+    for pixels in border:
+        edges += np.bincount(pixels, minlength=minlength)
+
+    return np.stack(
+        [
+            sums(xs),
+            sums(ys),
+            sums(xs**2),
+            sums(ys**2),
+            sums(ys * xs),
+            sums(hue),
+            edges,
+        ]
+    )
+
+
+def _label_features(leaf: Leaf, moments: np.ndarray) -> dict:
+    """
+    Returns the per label features from the sums of _label_moments, as a dict of column name to array
+    indexed by label. Positions are in pixels of the leaf image, areas and lengths in the units of the lesion sizes.
+    """
+    config = pipeline_config(leaf)
+    to_area = (
+        leaf.pixel_area * config.reference_area_mm / leaf.reference_area
+        if leaf.reference
+        else leaf.pixel_area
+    )
+    sum_x, sum_y, sum_xx, sum_yy, sum_xy, sum_hue, edges = moments
+    counts = np.maximum(leaf.label_sizes, 1)
+    centroid_x, centroid_y = sum_x / counts, sum_y / counts
+
+    # The eccentricity of the ellipse with the same second central moments as the label,
+    # which is 0 for single pixels
+    var_x = sum_xx / counts - centroid_x**2
+    var_y = sum_yy / counts - centroid_y**2
+    cov_xy = sum_xy / counts - centroid_x * centroid_y
+    spread = np.sqrt(((var_x - var_y) / 2) ** 2 + cov_xy**2)
+    major = (var_x + var_y) / 2 + spread
+    minor = np.maximum((var_x + var_y) / 2 - spread, 0)
+    eccentricity = np.sqrt(
+        1 - np.divide(minor, major, out=np.ones_like(major), where=counts > 1)
+    )
+
+    # Bounding boxes as (left, top, right, bottom), with an empty box for label 0
+    boxes = np.zeros((len(counts), 4), dtype=np.int64)
+    boxes[1:] = [
+        (cols.start, rows.start, cols.stop, rows.stop)
+        for rows, cols in label_slices(leaf)
+    ]
+    return {
+        "area": leaf.label_sizes * to_area,
+        "centroid_x": centroid_x,
+        "centroid_y": centroid_y,
+        "left": boxes[:, 0],
+        "top": boxes[:, 1],
+        "right": boxes[:, 2],
+        "bottom": boxes[:, 3],
+        "perimeter": edges * math.sqrt(to_area),
+        "eccentricity": eccentricity,
+        "mean_hue": sum_hue / counts,
+    }
+
+
+@profile_stage
+def filter_lesions(leaf: Leaf) -> None:
+    """
+    Takes a leaf object with labeled lesions as input, filters the lesions by size and highlights them in the modified image.
+    Only the cached label sizes are used, so this can be rerun whenever the lesion size threshold changes.
+    """
 
     # Filter the lesions based on the size threshold
-    leaf.labeled_pixels = labeled
-    classes, sizes = np.unique(labeled, return_counts=True)
+    config = pipeline_config(leaf)
+    labeled = leaf.labeled_pixels
+    sizes = (leaf.label_sizes * leaf.pixel_area).astype(float)
     if leaf.reference:
-        leaf.lesion_class_map = {
-            int(k): float(v)
-            for k, v in zip(
-                classes, sizes * settings["reference_area_mm"] / leaf.reference_area
-            )
-            if v > leaf.lesion_size_threshold
-        }
+        sizes = sizes * config.reference_area_mm / leaf.reference_area
     else:
         leaf.lesion_size_threshold = (
             10.0 if leaf.lesion_size_threshold == 0.01 else leaf.lesion_size_threshold
         )
-        leaf.lesion_class_map = {
-            int(k): float(v)
-            for k, v in zip(classes, sizes)
-            if v > leaf.lesion_size_threshold
-        }
+    lesion_lut = sizes > leaf.lesion_size_threshold
 
     # Remove segmented classes 0 and 1 since they represent the background and the leaf
-    leaf.lesion_class_map.pop(0)
-    leaf.lesion_class_map.pop(1)
-
-    # Create a color map for the lesions
-    class_color = {}
-    for class_value in leaf.lesion_class_map.keys():
-        class_color[class_value] = value_to_color(
-            leaf.lesion_class_map[class_value],
-            min(leaf.lesion_class_map.values()),
-            max(leaf.lesion_class_map.values()),
+    lesion_lut[:2] = False
+    if leaf.bbox is not None:
+        # A leaf cropped from a tray only keeps the lesions inside its leaf region, like _split_regions
+        lesion_lut &= np.bincount(labeled[leaf.leaf_mask], minlength=len(sizes)) > 0
+    classes = np.flatnonzero(lesion_lut)
+    lesion_sizes = sizes[classes]
+    leaf.lesion_class_map = dict(zip(classes.tolist(), lesion_sizes.tolist()))
+
+    # Build a lookup table from label to colour, masked by the leaf binary
+    color_lut = np.zeros((len(sizes), 3), dtype=np.uint8)
+    if len(lesion_sizes):
+        color_lut[classes] = values_to_colors(
+            lesion_sizes, lesion_sizes.min(), lesion_sizes.max()
         )
+    leaf.lesion_colors = color_lut
 
     # Create a new image with the lesions highlighted
-    leaf_pixels = leaf.leaf_binary.load()
-    leaf.lesion_area = 0
-    for y in range(leaf.labeled_pixels.shape[0]):
-        for x in range(leaf.labeled_pixels.shape[1]):
-            if (labeled[y, x] not in class_color.keys()) or (
-                leaf_pixels[x, y] == (0, 0, 0)
-            ):
-                continue
-            leaf.modified_image.putpixel((x, y), class_color[labeled[y, x]])
-            leaf.lesion_area += 1
+    painted_pixels = 0
+    for top, bottom, _, _ in row_tiles(labeled.shape[0], config.tile_rows):
+        strip = labeled[top:bottom]
+        lesion_mask = lesion_lut[strip] & leaf.leaf_mask[top:bottom]
+        leaf.modified_image.paste(
+            Image.fromarray(color_lut[strip]), (0, top), Image.fromarray(lesion_mask)
+        )
+        painted_pixels += int(np.count_nonzero(lesion_mask))
+    leaf.lesion_area = painted_pixels * leaf.pixel_area
 
     # Save calculated values to the leaf object
     leaf.lesion_area = (
-        (leaf.lesion_area * settings["reference_area_mm"]) / leaf.reference_area
+        (leaf.lesion_area * config.reference_area_mm) / leaf.reference_area
         if leaf.reference
         else leaf.lesion_area
     )
     leaf.lesion_area_percentage = 100 * leaf.lesion_area / leaf.leaf_area
 
-    leaf.average_lesion_size = np.mean(list(leaf.lesion_class_map.values()))
-    leaf.min_lesion_size = min(list(leaf.lesion_class_map.values()))
-    leaf.max_lesion_size = max(list(leaf.lesion_class_map.values()))
-    leaf.num_lesions = len(list(leaf.lesion_class_map.values()))
+    leaf.num_lesions = len(lesion_sizes)
+    if leaf.num_lesions:
+        leaf.average_lesion_size = lesion_sizes.mean()
+        leaf.min_lesion_size = float(lesion_sizes.min())
+        leaf.max_lesion_size = float(lesion_sizes.max())
+    else:
+        leaf.average_lesion_size = leaf.min_lesion_size = leaf.max_lesion_size = 0
 
 
-def append_reference_area_binary(leaf: Leaf) -> None:
+def label_slices(leaf: Leaf) -> list:
     """
-    Takes a leaf object as input and saves a binary image with the reference area highlighted in white, to the object.
+    Takes a leaf object with labeled lesions as input and returns the bounding box slices of each label,
+    where label n is at index n - 1. They are computed on first use and kept on the object.
     """
+    if leaf.label_slices is None:
+        leaf.label_slices = ndimage.find_objects(leaf.labeled_pixels)
+    return leaf.label_slices
 
-    hsv_img = leaf.img.convert("HSV")
-    hsv = np.array(hsv_img)
 
-    # Create a mask of pink regions
-    hues = hsv[:, :, 0] > settings[leaf.background_colour]["reference_area"]["min_hue"]
-    saturation = (
-        hsv[:, :, 1]
-        > settings[leaf.background_colour]["reference_area"]["min_saturation"]
+def remove_lesion(leaf: Leaf, point: tuple[int, int]) -> bool:
+    """
+    Takes a processed leaf object and an (x, y) point as input, and removes the lesion at that point from the
+    modified image and the lesion statistics. Only the pixels inside the lesion's bounding box are touched.
+    The removal is recorded in the leaf's edit log and clears its redo stack.
+    Returns False if there is no lesion at the point.
+    """
+    if not _remove_lesion(leaf, point):
+        return False
+    leaf.undone_edits = []
+    return True
+
+
+def undo_edit(leaf: Leaf) -> LesionEdit:
+    """
+    Takes a leaf object as input and restores the most recently removed lesion in the modified image and
+    the lesion statistics. Returns the undone edit, or None if there is nothing to undo.
+    """
+    if not leaf.edits:
+        return None
+    edit = leaf.edits.pop()
+
+    # Image modification, the lesion colour is only painted inside the leaf as in filter_lesions
+    rows, cols = label_slices(leaf)[edit.class_value - 1]
+    box = (cols.start, rows.start, cols.stop, rows.stop)
+    label_mask = leaf.labeled_pixels[rows, cols] == edit.class_value
+    lesion_mask = label_mask & leaf.leaf_mask[rows, cols]
+    leaf.modified_image.paste(
+        leaf.outlined_image.crop(box), box, Image.fromarray(label_mask)
+    )
+    leaf.modified_image.paste(
+        tuple(int(c) for c in leaf.lesion_colors[edit.class_value]),
+        box,
+        Image.fromarray(lesion_mask),
     )
-    values = (
-        hsv[:, :, 2] > settings[leaf.background_colour]["reference_area"]["min_value"]
+
+    # Values modification
+    leaf.lesion_class_map[edit.class_value] = edit.size
+    _update_lesion_area(leaf, edit.size)
+    leaf.num_lesions += 1
+    leaf.average_lesion_size += (
+        edit.size - leaf.average_lesion_size
+    ) / leaf.num_lesions
+    if leaf.num_lesions == 1:
+        leaf.min_lesion_size = leaf.max_lesion_size = edit.size
+    else:
+        leaf.max_lesion_size = max(leaf.max_lesion_size, edit.size)
+        leaf.min_lesion_size = min(leaf.min_lesion_size, edit.size)
+
+    leaf.undone_edits.append(edit)
+    return edit
+
+
+def redo_edit(leaf: Leaf) -> LesionEdit:
+    """
+    Takes a leaf object as input and removes the most recently restored lesion again.
+    Returns the redone edit, or None if there is nothing to redo.
+    """
+    while leaf.undone_edits:
+        edit = leaf.undone_edits.pop()
+        if _remove_lesion(leaf, edit.point):
+            return leaf.edits[-1]
+    return None
+
+
+def replay_edits(leaf: Leaf, edits: list) -> None:
+    """
+    Takes a freshly processed leaf object and an edit log as input, and removes the lesions at the logged
+    points again. Points that no longer fall on a lesion, e.g. after a threshold change, are dropped from the log.
+    """
+    leaf.edits = []
+    for edit in edits:
+        _remove_lesion(leaf, edit.point)
+
+
+def _remove_lesion(leaf: Leaf, point: tuple[int, int]) -> bool:
+    """
+    Removes the lesion at the point and appends the removal to the edit log, leaving the redo stack alone.
+    """
+    class_value = int(leaf.labeled_pixels[point[1], point[0]])
+    if class_value not in leaf.lesion_class_map:
+        return False
+
+    # Image modification
+    rows, cols = label_slices(leaf)[class_value - 1]
+    lesion_mask = leaf.labeled_pixels[rows, cols] == class_value
+    leaf.modified_image.paste(
+        (0, 0, 0),
+        (cols.start, rows.start, cols.stop, rows.stop),
+        Image.fromarray(lesion_mask),
     )
 
-    if np.sum(hues * saturation * values) > (hsv.shape[0] * hsv.shape[1] * 0.01):
+    # Values modification
+    size = leaf.lesion_class_map.pop(class_value)
+    _update_lesion_area(leaf, -size)
+    leaf.num_lesions -= 1
+    if leaf.num_lesions == 0:
+        leaf.average_lesion_size = leaf.min_lesion_size = leaf.max_lesion_size = 0
+    else:
+        leaf.average_lesion_size += (leaf.average_lesion_size - size) / leaf.num_lesions
+        # The extremes only need a rescan when the removed lesion was one of them
+        if size == leaf.max_lesion_size:
+            leaf.max_lesion_size = max(leaf.lesion_class_map.values())
+        if size == leaf.min_lesion_size:
+            leaf.min_lesion_size = min(leaf.lesion_class_map.values())
+
+    leaf.edits.append(LesionEdit(point, class_value, size))
+    return True
+
+
+def _update_lesion_area(leaf: Leaf, change: float) -> None:
+    """
+    Changes the lesion area of the leaf object by the given amount and updates the values derived from it.
+    """
+    leaf.lesion_area += change
+    leaf.lesion_area_percentage = 100 * leaf.lesion_area / leaf.leaf_area
+    if leaf.reference:
+        leaf.lesion_area_mm2 = (
+            leaf.lesion_area * pipeline_config(leaf).reference_area_mm
+        ) / leaf.reference_area
+
+
+def _dark_threshold(hsv: np.ndarray, leaf: Leaf, config: PipelineConfig) -> np.ndarray:
+    """
+    Selects the dark pixels used to detect a black background.
+    """
+    return hsv[:, :, 2] < 70
+
+
+def _reference_threshold(
+    hsv: np.ndarray, leaf: Leaf, config: PipelineConfig
+) -> np.ndarray:
+    """
+    Selects the pink pixels of the reference area.
+    """
+    reference_area = config.thresholds(leaf.background_colour).reference_area
+    hues = hsv[:, :, 0] > reference_area.min_hue
+    saturation = hsv[:, :, 1] > reference_area.min_saturation
+    values = hsv[:, :, 2] > reference_area.min_value
+    return hues & saturation & values
+
+
+def _leaf_threshold(hsv: np.ndarray, leaf: Leaf, config: PipelineConfig) -> np.ndarray:
+    """
+    Selects the pixels with the colour of leaf tissue.
+    """
+    leaf_area = config.thresholds(leaf.background_colour).leaf_area
+    min_hues = hsv[:, :, 0] > leaf_area.min_hue
+    max_hues = hsv[:, :, 0] < leaf_area.max_hue
+    saturation = hsv[:, :, 1] > leaf_area.min_saturation
+    values = hsv[:, :, 2] > leaf_area.min_value
+    return min_hues & max_hues & saturation & values
+
+
+def _lesion_values(hsv: np.ndarray, leaf: Leaf, config: PipelineConfig) -> np.ndarray:
+    """
+    Keeps the value of the pixels with the hue and saturation of healthy leaf tissue and sets the rest to 0.
+    Pixels brighter than the intensity threshold are the healthy tissue, i.e. the lesions are left out.
+    """
+    lesion_area = config.thresholds(leaf.background_colour).lesion_area
+    min_hues = hsv[:, :, 0] > lesion_area.min_hue
+    max_hues = hsv[:, :, 0] < lesion_area.max_hue
+    saturation = hsv[:, :, 1] > lesion_area.min_saturation
+    return np.where(min_hues & max_hues & saturation, hsv[:, :, 2], 0)
+
+
+@profile_stage
+def append_reference_area_binary(leaf: Leaf) -> None:
+    """
+    Takes a leaf object as input and saves a binary image with the reference area highlighted in white, to the object.
+    """
+
+    # Create a mask of pink regions
+    reference_mask = threshold_mask(leaf, _reference_threshold)
+
+    if np.sum(reference_mask) > (
+        reference_mask.shape[0] * reference_mask.shape[1] * 0.01
+    ):
         leaf.reference = True
     else:
         leaf.reference = False
         return
 
-    new_img = Image.fromarray(np.uint8(hues * saturation * values * 255))
-
     # Remove noise
-    new_img = new_img.filter(
-        ImageFilter.MedianFilter(settings["median_blur_size"]["reference"])
+    config = pipeline_config(leaf)
+    reference_mask = apply_in_tiles(
+        median_filter_mask,
+        reference_mask,
+        scaled_length(config.reference_blur_size, leaf) | 1,
+        config.tile_rows,
     )
 
-    leaf.reference_binary = new_img.convert("RGB").copy()
+    leaf.reference_mask = reference_mask
 
     # Mark the reference area in the image and save calculated values to the leaf object
-    pixels = leaf.modified_image.load()
-    reference_mask = leaf.reference_binary.load()
-    for i in range(leaf.img.size[0]):  # for every pixel:
-        for j in range(leaf.img.size[1]):
-            if reference_mask[i, j] == (255, 255, 255):  # if white in reference mask
-                leaf.reference_area += 1
-                pixels[i, j] = (0, 255, 0)  # change to green
+    leaf.reference_area = int(np.count_nonzero(reference_mask)) * leaf.pixel_area
+    leaf.modified_image.paste((0, 255, 0), mask=Image.fromarray(reference_mask))
 
 
+@profile_stage
 def append_leaf_area_binary(leaf: Leaf) -> None:
     """
     Takes a leaf object as input and saves a binary image with the leaf area highlighted in white, to the object.
     """
 
-    hsv_img = leaf.img.convert("HSV")
-    hsv = np.array(hsv_img)
-
     # Create a mask of the estimated leaf region using image thresholding
-    min_hues = hsv[:, :, 0] > settings[leaf.background_colour]["leaf_area"]["min_hue"]
-    max_hues = hsv[:, :, 0] < settings[leaf.background_colour]["leaf_area"]["max_hue"]
-    saturation = (
-        hsv[:, :, 1] > settings[leaf.background_colour]["leaf_area"]["min_saturation"]
+    config = pipeline_config(leaf)
+    leaf_mask = threshold_mask(leaf, _leaf_threshold)
+
+    # Mark the leaf boundary and fill the region it encloses
+    if config.leaf_segmentation == "mask":
+        leaf_region = _leaf_region_from_mask(leaf, leaf_mask)
+    else:
+        leaf_region = _leaf_region_from_contours(leaf, leaf_mask)
+
+    # Save calculated values to the leaf object
+    leaf.leaf_area = np.sum(leaf_region) * leaf.pixel_area
+    leaf.leaf_area = (
+        leaf.leaf_area * config.reference_area_mm / leaf.reference_area
+        if leaf.reference
+        else leaf.leaf_area
     )
-    values = hsv[:, :, 2] > settings[leaf.background_colour]["leaf_area"]["min_value"]
+    leaf.leaf_mask = leaf_region
 
-    new_img = Image.fromarray(np.uint8(min_hues * max_hues * saturation * values * 255))
+
+def _leaf_region_from_contours(leaf: Leaf, leaf_mask: np.ndarray) -> np.ndarray:
+    """
+    Marks the leaf boundary by contouring the threshold mask and fills the boundary around the image centre.
+    """
+    new_img = Image.fromarray(np.uint8(leaf_mask * 255))
 
     # Apply contouring to mark the leaf boundary
     image_gray = new_img.convert("L")
@@ -169,14 +641,15 @@ def append_leaf_area_binary(leaf: Leaf) -> None:
     enhancer = ImageEnhance.Contrast(image_gray)
     image_gray = enhancer.enhance(2)
 
-    level = settings[leaf.background_colour]["leaf_area"]["level"]
+    config = pipeline_config(leaf)
+    level = config.thresholds(leaf.background_colour).leaf_area.level
     contours = (
         measure.find_contours(np.array(image_gray), level=level - 10)
         + measure.find_contours(np.array(image_gray), level=level)
         + measure.find_contours(np.array(image_gray), level=level + 10)
     )
 
-    new_img = Image.new("RGB", (image_gray.size[0], image_gray.size[1]), color="black")
+    new_img = Image.new("L", (image_gray.size[0], image_gray.size[1]), color=0)
     draw_on_white = ImageDraw.Draw(new_img)
     draw_on_img = ImageDraw.Draw(leaf.modified_image)
 
@@ -189,61 +662,127 @@ def append_leaf_area_binary(leaf: Leaf) -> None:
             contour_points = (
                 np.flip(contour, axis=1).flatten().tolist()
             )  # Convert contour to list of points
-            draw_on_white.line(contour_points, fill="white", width=2)  #blue, 2
-            draw_on_img.line(contour_points, fill="blue", width=5)
+            draw_on_white.line(contour_points, fill=255, width=scaled_length(2, leaf))
+            draw_on_img.line(contour_points, fill="blue", width=scaled_length(5, leaf))
 
-    leaf.leaf_outline_binary = new_img.copy().convert("RGB")
+    outline = np.asarray(new_img) > 0
+    leaf.leaf_outline_mask = outline
 
-    # Floodfill the image to remove any noise within the boundary
-    ImageDraw.floodfill(
-        new_img, (new_img.size[0] / 2, new_img.size[1] / 2), (255, 255, 255)
-    )
+    # Floodfill from the image centre to remove any noise within the boundary. Labeling the
+    # black regions gives the same result as ImageDraw.floodfill without a per pixel loop.
+    centre = (outline.shape[0] // 2, outline.shape[1] // 2)
+    if outline[centre]:
+        return outline
+    labeled, _ = label_mask(~outline, config.tile_rows)
+    return outline | (labeled == labeled[centre])
 
-    # Save calculated values to the leaf object
-    leaf.leaf_area = np.sum(np.asarray(new_img.convert("1")))
-    leaf.leaf_area = (
-        leaf.leaf_area * settings["reference_area_mm"] / leaf.reference_area
-        if leaf.reference
-        else leaf.leaf_area
-    )
-    leaf.leaf_binary = new_img.convert("RGB").copy()
 
+def _leaf_region_from_mask(leaf: Leaf, leaf_mask: np.ndarray) -> np.ndarray:
+    """
+    Derives the leaf region from the threshold mask with a median filter and connected components,
+    and marks the boundary band around it. This does not assume the leaf covers the image centre.
+    """
 
-def append_lesion_area_binary(leaf: Leaf) -> None:
+    labeled, num_objects = _leaf_components(leaf, leaf_mask)
+
+    # Keep the regions spanning at least a quarter of the image height, like the contour filter
+    is_leaf = np.zeros(num_objects + 1, dtype=bool)
+    for label, rows in enumerate(ndimage.find_objects(labeled), start=1):
+        is_leaf[label] = rows[0].stop - rows[0].start >= leaf_mask.shape[0] / 4
+    leaf_region = _fill_holes(is_leaf[labeled], pipeline_config(leaf).tile_rows)
+
+    _mark_leaf_boundary(leaf, leaf_region)
+    return leaf_region
+
+
+def _leaf_components(leaf: Leaf, leaf_mask: np.ndarray) -> tuple:
     """
-    Takes a leaf object as input and saves a binary image with the non lesion area highlighted in white, to the object.
-    i.e. the lesion area is black.
+    Removes noise from the leaf threshold mask with a median filter and labels its connected regions.
     """
+    config = pipeline_config(leaf)
+    leaf_mask = apply_in_tiles(
+        median_filter_mask,
+        leaf_mask,
+        scaled_length(config.leaf_blur_size, leaf) | 1,
+        config.tile_rows,
+    )
+    return label_mask(leaf_mask, config.tile_rows)
 
-    hsv_img = leaf.img.convert("HSV")
-    hsv = np.array(hsv_img)
 
-    # Create a mask of the estimated lesion region using image thresholding
-    min_hues = hsv[:, :, 0] > settings[leaf.background_colour]["lesion_area"]["min_hue"]
-    max_hues = hsv[:, :, 0] < settings[leaf.background_colour]["lesion_area"]["max_hue"]
-    saturation = (
-        hsv[:, :, 1] > settings[leaf.background_colour]["lesion_area"]["min_saturation"]
+def _fill_holes(region: np.ndarray, tile_rows: int) -> np.ndarray:
+    """
+    Fills the holes of a region, e.g. lesions, that are not connected to the image border.
+    """
+    background, _ = label_mask(~region, tile_rows)
+    border_labels = np.unique(
+        np.concatenate(
+            [background[0], background[-1], background[:, 0], background[:, -1]]
+        )
     )
-    values = hsv[:, :, 2] > leaf.minimum_lesion_area_value
+    return ~np.isin(background, border_labels[border_labels != 0])
+
 
-    leaf.lesion_binary = Image.fromarray(
-        np.uint8(min_hues * max_hues * saturation * values * 255)
+def _mark_leaf_boundary(leaf: Leaf, leaf_region: np.ndarray) -> None:
+    """
+    Saves the band around the boundary of the leaf region as the leaf outline, and marks a wider band in blue
+    in the modified image.
+    """
+    tile_rows = pipeline_config(leaf).tile_rows
+    leaf.leaf_outline_mask = apply_in_tiles(
+        boundary_band, leaf_region, scaled_length(3, leaf) | 1, tile_rows
     )
+    leaf.modified_image.paste(
+        (0, 0, 255),
+        mask=Image.fromarray(
+            apply_in_tiles(
+                boundary_band, leaf_region, scaled_length(5, leaf) | 1, tile_rows
+            )
+        ),
+    )
+
+
+def lesion_values(leaf: Leaf) -> np.ndarray:
+    """
+    Takes a leaf object as input and returns the HSV value of its pixels with the colour of healthy tissue, 0 elsewhere.
+    Comparing it with an intensity threshold gives the healthy tissue at that threshold, so every threshold tried
+    for a leaf shares a single pass over the HSV image. It is kept on the object until the leaf area stage reruns.
+    """
+    if leaf.lesion_values is None:
+        leaf.lesion_values = threshold_mask(leaf, _lesion_values, np.uint8)
+    return leaf.lesion_values
+
+
+def lesion_boundary(leaf: Leaf) -> np.ndarray:
+    """
+    Takes a leaf object as input and returns a mask of the estimated leaf boundary, which is marked as healthy tissue
+    to ensure lesions on the leaf boundary are included. It only depends on the leaf mask, so it is kept on the object
+    until the leaf area stage reruns.
+    """
+    if leaf.lesion_boundary is not None:
+        return leaf.lesion_boundary
+
+    config = pipeline_config(leaf)
+    if config.leaf_segmentation == "mask":
+        leaf.lesion_boundary = apply_in_tiles(
+            boundary_band, leaf.leaf_mask, scaled_length(11, leaf) | 1, config.tile_rows
+        )
+        return leaf.lesion_boundary
 
-    image_gray = leaf.leaf_binary.copy().convert("L")
+    image_gray = Image.fromarray(np.uint8(leaf.leaf_mask) * 255)
 
-    # Enhance contrast and use contouring to mark the estimated leaf boundary to ensure lesions on the leaf boundary are included
+    # Enhance contrast and use contouring to mark the estimated leaf boundary
     enhancer = ImageEnhance.Contrast(image_gray)
     image_gray = enhancer.enhance(2)
 
-    level = settings[leaf.background_colour]["lesion_area"]["level"]
+    level = config.thresholds(leaf.background_colour).lesion_area.level
     contours = (
         measure.find_contours(np.array(image_gray), level=level - 10)
         + measure.find_contours(np.array(image_gray), level=level)
         + measure.find_contours(np.array(image_gray), level=level + 10)
     )
 
-    draw = ImageDraw.Draw(leaf.lesion_binary)
+    boundary = Image.new("L", image_gray.size)
+    draw = ImageDraw.Draw(boundary)
 
     for contour in contours:
         x_coords = [coord[0] for coord in contour]
@@ -254,20 +793,340 @@ def append_lesion_area_binary(leaf: Leaf) -> None:
             contour_points = (
                 np.flip(contour, axis=1).flatten().tolist()
             )  # Convert contour to list of points
-            draw.line(contour_points, fill="white", width=10)
+            draw.line(contour_points, fill=255, width=scaled_length(10, leaf))
+
+    leaf.lesion_boundary = np.asarray(boundary) > 0
+    return leaf.lesion_boundary
+
+
+@profile_stage
+def append_lesion_area_binary(leaf: Leaf) -> None:
+    """
+    Takes a leaf object as input and saves a binary image with the non lesion area highlighted in white, to the object.
+    i.e. the lesion area is black.
+    """
+
+    # Create a mask of the estimated lesion region using image thresholding, with the leaf boundary marked
+    lesion_mask = lesion_values(leaf) > leaf.minimum_lesion_area_value
+    lesion_mask |= lesion_boundary(leaf)
+    leaf.lesion_binary = Image.fromarray(np.uint8(lesion_mask) * 255)
 
     # Segment individual lesions
     segment_lesions(leaf)
 
 
-def process_image(leaf: Leaf) -> None:
+def process_image(
+    leaf: Leaf, cache: ResultCache = None, config: PipelineConfig = None
+) -> None:
     """
     Takes a leaf object as input and calls the functions required to process the object.
+    Stages whose inputs have not changed since the last run reuse the results cached on the object.
+    If an on-disk result cache is given, it is checked before anything is computed and stores new results.
+    The config given here, or else the leaf object's own, or else the one built from the module settings, is kept on
+    the leaf object, so later runs use the config its cached stages were computed with. Leaves cropped from a tray by process_tray can only rerun the lesion stages.
     """
 
     start_time = time.time()
-    leaf.modified_image = leaf.img.copy()
-    append_reference_area_binary(leaf)
-    append_leaf_area_binary(leaf)
-    append_lesion_area_binary(leaf)
+    leaf.config = config or leaf.config or settings.config()
+    stale_stages = _stale_stages(leaf)
+    if "leaf_area" in stale_stages and leaf.bbox is not None:
+        # The leaf mask and reference of a crop come from its tray, which the crop alone cannot reproduce
+        raise ValueError(
+            f"{leaf.name} was cropped from a tray, reprocess the tray to change its background colour"
+        )
+    replay = bool(stale_stages and leaf.edits)
+    cache_key = (
+        cache.key(leaf, pipeline_config(leaf))
+        if cache is not None and stale_stages
+        else None
+    )
+    if "leaf_area" in stale_stages:
+        leaf.lesion_values = leaf.lesion_boundary = None
+    if cache_key is not None and cache.load(leaf, cache_key):
+        stale_stages, cache_key = set(), None
+    if "leaf_area" in stale_stages:
+        leaf.modified_image = leaf.img.copy()
+        append_reference_area_binary(leaf)
+        append_leaf_area_binary(leaf)
+        leaf.outlined_image = leaf.modified_image.copy()
+    if "lesion_area" in stale_stages:
+        leaf.modified_image = leaf.outlined_image.copy()
+        append_lesion_area_binary(leaf)
+    elif "lesion_filter" in stale_stages:
+        leaf.modified_image = leaf.outlined_image.copy()
+        filter_lesions(leaf)
+    if cache_key is not None:
+        cache.store(leaf, cache_key)
+    if replay:
+        replay_edits(leaf, leaf.edits)
+    leaf.stage_inputs = _stage_inputs(leaf)
     leaf.run_time = time.time() - start_time
+
+
+def process_leaf(
+    leaf: Leaf, cache: ResultCache = None, config: PipelineConfig = None
+) -> None:
+    """
+    Takes a leaf object as input, detects its background colour and processes it with the low intensity threshold.
+    Leaves with more than 3.5% lesion area are reprocessed with the high intensity threshold, which only reruns
+    the lesion stages as the thresholded lesion values and the leaf boundary are shared by both passes.
+    The caches the pipeline can recompute are dropped afterwards, see Leaf.drop_caches.
+    """
+
+    start_time = time.time()
+    leaf.profile = {}
+    leaf.config = config or leaf.config or settings.config()
+    background_detector(leaf)
+    thresholds = pipeline_config(leaf).thresholds(leaf.background_colour)
+    leaf.minimum_lesion_area_value = thresholds.low_intensity
+    process_image(leaf, cache)
+    if leaf.lesion_area_percentage > 3.5:
+        leaf.minimum_lesion_area_value = thresholds.high_intensity
+        process_image(leaf, cache)
+    leaf.drop_caches()
+    leaf.run_time = time.time() - start_time
+
+
+def measure_leaves(
+    leaf: Leaf,
+    multi_leaf: bool = False,
+    cache: ResultCache = None,
+    config: PipelineConfig = None,
+) -> list:
+    """
+    Takes a leaf object as input and processes it with process_leaf, or with process_tray if its image holds several leaves.
+    Returns the processed leaf objects without the caches the pipeline can recompute, so it can run in a worker process.
+    """
+    if not multi_leaf:
+        process_leaf(leaf, cache, config)
+        return [leaf]
+    leaves = process_tray(leaf, config)
+    for leaf in leaves:
+        leaf.drop_caches()
+    return leaves
+
+
+def process_tray(tray: Leaf, config: PipelineConfig = None) -> list:
+    """
+    Takes a leaf object holding an image of several leaves, e.g. a scanned tray, as input and processes every leaf in it
+    in a single pass. The leaves are the connected regions of the leaf mask, so touching leaves are measured as one.
+    Returns a leaf object per region, cropped to its bounding box, with the same measurements as process_leaf.
+    The list is empty if no leaf is found in the image.
+    """
+
+    start_time = time.time()
+    tray.profile = {}
+    tray.config = config = config or tray.config or settings.config()
+    background_detector(tray)
+    tray.modified_image = tray.img.copy()
+    append_reference_area_binary(tray)
+    regions, num_regions = leaf_regions(tray)
+    tray.leaf_mask = regions > 0
+    tray.leaf_area = np.count_nonzero(tray.leaf_mask) * tray.pixel_area
+    tray.leaf_area = (
+        tray.leaf_area * config.reference_area_mm / tray.reference_area
+        if tray.reference
+        else tray.leaf_area
+    )
+    _mark_leaf_boundary(tray, tray.leaf_mask)
+    tray.outlined_image = tray.modified_image.copy()
+    tray.lesion_boundary = apply_in_tiles(
+        boundary_band, tray.leaf_mask, scaled_length(11, tray) | 1, config.tile_rows
+    )
+
+    # Segment the lesions of every leaf at once, retrying the leaves with more than 3.5% lesion area
+    # at the high intensity threshold like process_leaf
+    leaves = [None] * num_regions
+    thresholds = config.thresholds(tray.background_colour)
+    for intensity in (thresholds.low_intensity, thresholds.high_intensity):
+        tray.minimum_lesion_area_value = intensity
+        tray.modified_image = tray.outlined_image.copy()
+        lesion_mask = lesion_values(tray) > tray.minimum_lesion_area_value
+        lesion_mask |= tray.lesion_boundary
+        tray.lesion_binary = Image.fromarray(np.uint8(lesion_mask) * 255)
+        segment_lesions(tray)
+        for i, leaf in enumerate(_split_regions(tray, regions, num_regions)):
+            if leaves[i] is None or leaves[i].lesion_area_percentage > 3.5:
+                leaves[i] = leaf
+        if all(leaf.lesion_area_percentage <= 3.5 for leaf in leaves):
+            break
+
+    tray.run_time = time.time() - start_time
+    for leaf in leaves:
+        leaf.run_time = tray.run_time / num_regions
+        # Each leaf gets its own copy, as reprocessing a leaf adds to its profile
+        leaf.profile = copy.deepcopy(tray.profile)
+    return leaves
+
+
+def leaf_regions(leaf: Leaf) -> tuple:
+    """
+    Takes a leaf object as input and labels every leaf in its image. Returns the labels and their number.
+    Regions smaller than the config's min_leaf_area_fraction of the largest one are treated as noise.
+    """
+    config = pipeline_config(leaf)
+    labeled, num_objects = _leaf_components(leaf, threshold_mask(leaf, _leaf_threshold))
+    sizes = np.bincount(labeled.ravel(), minlength=num_objects + 1)
+    sizes[0] = 0
+    is_leaf = sizes >= config.min_leaf_area_fraction * sizes.max()
+    is_leaf[0] = False
+    return label_mask(_fill_holes(is_leaf[labeled], config.tile_rows), config.tile_rows)
+
+
+def _split_regions(tray: Leaf, regions: np.ndarray, num_regions: int) -> list:
+    """
+    Splits a processed tray into a leaf object per leaf region, with the lesions inside each region
+    and the measurements derived from them. Lesions without any pixel inside a region are left out.
+    """
+    labeled = tray.labeled_pixels
+    lesion_lut = np.zeros(len(tray.label_sizes), dtype=bool)
+    lesion_lut[list(tray.lesion_class_map)] = True
+
+    # Every lesion lies inside a single region, so any of its pixels gives the region it belongs to
+    region_of_label = np.zeros(len(tray.label_sizes), dtype=np.int64)
+    region_of_label[labeled[tray.leaf_mask]] = regions[tray.leaf_mask]
+    region_pixels = np.bincount(regions.ravel(), minlength=num_regions + 1)
+    painted = lesion_lut[labeled] & tray.leaf_mask
+    painted_pixels = np.bincount(regions[painted], minlength=num_regions + 1)
+    to_area = (
+        pipeline_config(tray).reference_area_mm / tray.reference_area
+        if tray.reference
+        else 1
+    )
+
+    # Crop each region with a margin for the boundary bands drawn around it
+    margin = scaled_length(11, tray)
+    height, width = regions.shape
+    stem, suffix = Path(tray.name).stem, Path(tray.name).suffix
+    # The leaf masks of the crops come from the tray's regions, as the mask engine does
+    crop_config = dataclasses.replace(pipeline_config(tray), leaf_segmentation="mask")
+    leaves = []
+    for region, (rows, cols) in enumerate(ndimage.find_objects(regions), start=1):
+        box = (
+            max(0, cols.start - margin),
+            max(0, rows.start - margin),
+            min(width, cols.stop + margin),
+            min(height, rows.stop + margin),
+        )
+        crop = (slice(box[1], box[3]), slice(box[0], box[2]))
+        leaf = Leaf(
+            f"{tray.key}_{region}",
+            f"{stem}_{region}{suffix}",
+            tray.img.crop(box),
+            reference=tray.reference,
+            reference_area=tray.reference_area,
+            background_colour=tray.background_colour,
+            minimum_lesion_area_value=tray.minimum_lesion_area_value,
+            lesion_size_threshold=tray.lesion_size_threshold,
+            pixel_area=tray.pixel_area,
+            bbox=box,
+            dpi=tray.dpi,
+            config=crop_config,
+        )
+        leaf.leaf_mask = regions[crop] == region
+        leaf.leaf_outline_mask = boundary_band(
+            leaf.leaf_mask, scaled_length(3, tray) | 1
+        )
+        leaf.lesion_binary = tray.lesion_binary.crop(box)
+        leaf.lesion_values = tray.lesion_values[crop].copy()
+        leaf.lesion_boundary = tray.lesion_boundary[crop].copy()
+        leaf.modified_image = tray.modified_image.crop(box)
+        leaf.outlined_image = tray.outlined_image.crop(box)
+        leaf.labeled_pixels = labeled[crop].copy()
+        leaf.label_sizes = tray.label_sizes
+        leaf.lesion_colors = tray.lesion_colors
+        leaf.label_features = _crop_features(tray.label_features, box)
+
+        leaf.lesion_class_map = {
+            k: v
+            for k, v in tray.lesion_class_map.items()
+            if region_of_label[k] == region
+        }
+        leaf.leaf_area = region_pixels[region] * tray.pixel_area * to_area
+        leaf.lesion_area = painted_pixels[region] * tray.pixel_area * to_area
+        leaf.lesion_area_percentage = 100 * leaf.lesion_area / leaf.leaf_area
+        sizes = list(leaf.lesion_class_map.values())
+        leaf.num_lesions = len(sizes)
+        leaf.average_lesion_size = np.mean(sizes) if sizes else 0
+        leaf.min_lesion_size = min(sizes, default=0)
+        leaf.max_lesion_size = max(sizes, default=0)
+        leaf.stage_inputs = _stage_inputs(leaf)
+        leaves.append(leaf)
+    return leaves
+
+
+def _crop_features(features: dict, box: tuple) -> dict:
+    """
+    Returns the per label features with the positions moved into the crop box, or None if there are no features.
+    """
+    if features is None:
+        return None
+    left, top = box[:2]
+    offsets = {"centroid_x": left, "left": left, "right": left}
+    offsets.update(centroid_y=top, top=top, bottom=top)
+    return {
+        name: column - offsets[name] if name in offsets else column
+        for name, column in features.items()
+    }
+
+
+def process_preview(leaf: Leaf, scale: int) -> Leaf:
+    """
+    Processes the leaf object downsampled by scale in each direction for a fast preview and returns the preview leaf.
+    Areas are measured in full resolution pixels, so the preview measurements are comparable with the full result.
+    The preview leaf is kept on the leaf object, so later previews only rerun the stages affected by new settings.
+    The leaf object itself is not changed.
+    """
+    if leaf.preview is None or leaf.preview.pixel_area != scale**2:
+        leaf.preview = Leaf(
+            leaf.key, leaf.name, leaf.img.reduce(scale), pixel_area=scale**2
+        )
+    leaf.preview.config = leaf.config
+    leaf.preview.background_colour = leaf.background_colour
+    leaf.preview.minimum_lesion_area_value = leaf.minimum_lesion_area_value
+    leaf.preview.lesion_size_threshold = leaf.lesion_size_threshold
+    leaf.preview.edits = [
+        LesionEdit((edit.point[0] // scale, edit.point[1] // scale), 0, 0)
+        for edit in leaf.edits
+    ]
+    process_image(leaf.preview)
+    return leaf.preview
+
+
+def process_copy(leaf: Leaf) -> Leaf:
+    """
+    Processes a copy of the leaf object, e.g. at full resolution in a background thread while a preview is shown,
+    and returns the copy. The copy starts from the cached stages of the leaf, so only the stages affected by
+    changed settings rerun, and the leaf object itself is not changed. The copy is returned without the caches
+    the pipeline can recompute, as it replaces the leaf object in the session.
+    """
+    processed = copy.copy(leaf)
+    processed.profile = {}
+    processed.undone_edits = list(leaf.undone_edits)
+    process_image(processed)
+    processed.drop_caches()
+    return processed
+
+
+def _stage_inputs(leaf: Leaf) -> dict:
+    """
+    Returns the current inputs of each stage of process_image for the leaf object.
+    """
+    return {
+        stage: tuple(getattr(leaf, name) for name in inputs)
+        for stage, inputs in STAGE_INPUTS.items()
+    }
+
+
+def _stale_stages(leaf: Leaf) -> set:
+    """
+    Returns the stages of process_image that have to run for the leaf object. A stage is stale when one of its
+    inputs has changed since it last ran, or when an earlier stage is stale.
+    """
+    stale_stages = set()
+    for stage, inputs in STAGE_INPUTS.items():
+        if stale_stages or leaf.stage_inputs.get(stage) != tuple(
+            getattr(leaf, name) for name in inputs
+        ):
+            stale_stages.add(stage)
+    return stale_stages
@@ -1,11 +1,15 @@
 import streamlit as st
 from streamlit_echarts import st_echarts
-from leaflesiondetector.vis_data_pipeline import diseases, pie_data, boxplot_data
+from leaflesiondetector.vis_data_pipeline import load_disease_summary
 
 st.title(":chart_with_upwards_trend: Visualize the data")
 
 st.write("")
 
+# Aggregated over every batch in the results store
+summary = load_disease_summary()
+pie_data = [{"value": v["count"], "name": v["disease"]} for v in summary]
+
 piechart = {
     "title": {
         "text": "Disease types",
@@ -45,7 +49,7 @@ st_echarts(
 )
 
 subtext = ", ".join(
-    ["Disease " + str(i) + ": " + k for i, k in enumerate(diseases.keys())]
+    ["Disease " + str(i) + ": " + v["disease"] for i, v in enumerate(summary)]
 )
 
 boxplot = {
@@ -70,20 +74,11 @@ boxplot = {
             "top": "90%",
         },
     ],
-    "dataset": [
-        {"source": boxplot_data},
-        {
-            "transform": {
-                "type": "boxplot",
-                "config": {"itemNameFormatter": "Disease {value}"},
-            }
-        },
-        {"fromDatasetIndex": 1, "fromTransformResult": 1},
-    ],
     "tooltip": {"trigger": "item", "axisPointer": {"type": "shadow"}},
     "grid": {"left": "10%", "right": "10%", "bottom": "15%"},
     "xAxis": {
         "type": "category",
+        "data": ["Disease " + str(i) for i in range(len(summary))],
         "boundaryGap": True,
         "nameGap": 30,
         "splitArea": {"show": False},
@@ -95,8 +90,12 @@ boxplot = {
         "splitArea": {"show": True},
     },
     "series": [
-        {"name": "Boxplot", "type": "boxplot", "datasetIndex": 1},
-        {"name": "Outlier", "type": "scatter", "datasetIndex": 2},
+        {"name": "Boxplot", "type": "boxplot", "data": [v["box"] for v in summary]},
+        {
+            "name": "Outlier",
+            "type": "scatter",
+            "data": [[i, o] for i, v in enumerate(summary) for o in v["outliers"]],
+        },
     ],
 }
 st_echarts(boxplot, height="500px")
@@ -0,0 +1,75 @@
+import functools
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+# External profiler wrapping every profiled stage, see set_stage_profiler
+_stage_profiler = None
+
+# Largest traced memory seen by each profiled stage running on this thread, outermost first
+_running = threading.local()
+
+
+def set_stage_profiler(profiler) -> None:
+    """
+    Plugs an external profiler into every profiled stage. The profiler is called with the stage name and the
+    leaf object and must return a context manager that wraps the stage, e.g. one enabling a cProfile.Profile.
+    Pass None to remove it.
+    """
+    global _stage_profiler
+    _stage_profiler = profiler
+
+
+def profile_stage(stage):
+    """
+    Decorator recording the wall time, CPU time and peak allocated bytes of a pipeline stage in leaf.profile.
+    Repeated runs of a stage are accumulated and the peak is the largest of any run.
+
+    Memory is only measured while tracemalloc is tracing (tracemalloc.start() or PYTHONTRACEMALLOC=1),
+    since tracing slows the contour stages down several times. Otherwise peak_memory is None.
+    """
+
+    @functools.wraps(stage)
+    def wrapper(leaf, *args, **kwargs):
+        peaks = _running.__dict__.setdefault("peaks", [])
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # Hand the peak so far to the enclosing stage before resetting it for this one
+            start_memory, peak_memory = tracemalloc.get_traced_memory()
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak_memory)
+            tracemalloc.reset_peak()
+            peaks.append(start_memory)
+
+        profiler = (
+            nullcontext()
+            if _stage_profiler is None
+            else _stage_profiler(stage.__name__, leaf)
+        )
+        start_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        try:
+            with profiler:
+                return stage(leaf, *args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - start_time
+            cpu_time = time.process_time() - start_cpu_time
+            allocated = None
+            if tracing:
+                peak_memory = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if peaks:
+                    peaks[-1] = max(peaks[-1], peak_memory)
+                allocated = peak_memory - start_memory
+
+            record = leaf.profile.setdefault(
+                stage.__name__,
+                {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_memory": None},
+            )
+            record["calls"] += 1
+            record["wall_time"] += wall_time
+            record["cpu_time"] += cpu_time
+            if allocated is not None:
+                record["peak_memory"] = max(record["peak_memory"] or 0, allocated)
+
+    return wrapper
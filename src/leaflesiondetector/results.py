@@ -0,0 +1,315 @@
+import csv
+import io
+import json
+import zipfile
+from concurrent.futures import Executor
+from pathlib import Path
+from PIL import Image
+from leaflesiondetector.leaf import Leaf, LeafMetrics
+
+CSV_FIELDNAMES = [
+    "Image",
+    "Percentage area",
+    "Area",
+    "Run time (seconds)",
+    "Intensity threshold",
+    "Lesion size threshold",
+    "Average lesion size",
+    "Maximum lesion size",
+    "Minimum lesion size",
+    "Lesion map",
+    "Bounding box",
+]
+
+# The lesions.csv columns and the lesion feature each of them holds
+LESION_CSV_COLUMNS = {
+    "Lesion": "label",
+    "Area": "area",
+    "Centroid x": "centroid_x",
+    "Centroid y": "centroid_y",
+    "Left": "left",
+    "Top": "top",
+    "Right": "right",
+    "Bottom": "bottom",
+    "Perimeter": "perimeter",
+    "Eccentricity": "eccentricity",
+    "Mean hue": "mean_hue",
+}
+LESION_CSV_FIELDNAMES = ["Image", *LESION_CSV_COLUMNS]
+
+# Image formats that are already compressed, so zipping them again only costs time
+COMPRESSED_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+
+def csv_row(leaf: Leaf) -> dict:
+    """
+    This function returns the CSV row for a leaf or its LeafMetrics record.
+    """
+    return {
+        "Image": leaf.name,
+        "Percentage area": leaf.lesion_area_percentage,
+        "Area": (
+            str(leaf.lesion_area) + " mm2"
+            if leaf.reference
+            else str(leaf.lesion_area) + " px"
+        ),
+        "Run time (seconds)": leaf.run_time,
+        "Intensity threshold": leaf.minimum_lesion_area_value,
+        "Lesion size threshold": leaf.lesion_size_threshold,
+        "Average lesion size": leaf.average_lesion_size,
+        "Maximum lesion size": leaf.max_lesion_size,
+        "Minimum lesion size": leaf.min_lesion_size,
+        "Lesion map": list(leaf.lesion_class_map.values()),
+        "Bounding box": leaf.bbox if leaf.bbox is not None else "",
+    }
+
+
+def lesion_csv_rows(leaf: Leaf) -> list:
+    """
+    This function returns a lesions.csv row per lesion of a leaf or its LeafMetrics record, or no rows
+    if its lesion features were not computed.
+    """
+    features = leaf.lesion_features
+    if features is None:
+        return []
+    columns = [features[name].tolist() for name in LESION_CSV_COLUMNS.values()]
+    return [
+        {"Image": leaf.name, **dict(zip(LESION_CSV_COLUMNS, values))}
+        for values in zip(*columns)
+    ]
+
+
+def lesion_csv_text(leaves: list) -> str:
+    """
+    This function returns the features of every lesion as CSV text.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=LESION_CSV_FIELDNAMES)
+    writer.writeheader()
+    for leaf in leaves:
+        writer.writerows(lesion_csv_rows(leaf))
+    return buffer.getvalue()
+
+
+def write_csv(file: str, leaves: list) -> None:
+    """
+    This function writes the results of the image processing to a CSV file.
+    """
+    with open(file, "w") as f:
+        f.write(csv_text(leaves))
+
+
+def csv_text(leaves: list) -> str:
+    """
+    This function returns the results of the image processing as CSV text.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDNAMES)
+    writer.writeheader()
+    for leaf in leaves:
+        writer.writerow(csv_row(leaf))
+    return buffer.getvalue()
+
+
+def profile_json(leaves: list) -> str:
+    """
+    This function returns the per stage profile of each leaf as a JSON document.
+    """
+    return json.dumps(
+        [{"Image": leaf.name, "stages": leaf.profile} for leaf in leaves], indent=2
+    )
+
+
+def encode_leaf_images(leaf: Leaf) -> dict:
+    """
+    This function encodes the modified image and the binaries of a leaf in the format of the original file.
+    Returns a dictionary from file name to the encoded bytes.
+    """
+    stem, suffix = Path(leaf.name).stem, Path(leaf.name).suffix
+    image_format = Image.registered_extensions()[suffix.lower()]
+    images = {
+        f"{stem}_modified{suffix}": leaf.modified_image,
+        f"{stem}_leaf_binary{suffix}": leaf.leaf_binary,
+        f"{stem}_leaf_outline_binary{suffix}": leaf.leaf_outline_binary,
+        f"{stem}_lesion_binary{suffix}": leaf.lesion_binary,
+    }
+    encoded = {}
+    for file_name, image in images.items():
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+        encoded[file_name] = buffer.getvalue()
+    return encoded
+
+
+def zip_compression(file_name: str) -> int:
+    """
+    This function returns the zip compression method for a file, storing already compressed images as they are.
+    """
+    if Path(file_name).suffix.lower() in COMPRESSED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def result_revision(leaf: Leaf) -> tuple:
+    """
+    This function returns a value that changes whenever the results of a leaf change, i.e. it is reprocessed
+    or lesions are removed or restored.
+    """
+    return (
+        leaf.key,
+        leaf.name,
+        leaf.content_hash,
+        leaf.run_time,
+        tuple(leaf.stage_inputs.items()),
+        tuple((edit.point, edit.class_value) for edit in leaf.edits),
+    )
+
+
+def save_leaf_images(leaf: Leaf, folder: str) -> None:
+    """
+    This function saves the modified image and the binaries of a leaf to a folder.
+    """
+    for file_name, data in encode_leaf_images(leaf).items():
+        (Path(folder) / file_name).write_bytes(data)
+
+
+class ResultsWriter:
+    """
+    Streams the results of processed leaves to a folder, or to a zip archive when the path ends in .zip.
+    Each leaf's CSV row and images are written as soon as it is added, so only its LeafMetrics record is kept.
+    The layout matches the archive built by the app: results.csv, profile.json and a modified_images folder,
+    and lesions.csv if the lesion features were computed.
+    """
+
+    def __init__(self, path: str, save_images: bool = True):
+        self.path = Path(path)
+        self.save_images = save_images
+        self.records = []
+        if self.path.suffix.lower() == ".zip":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._zip = zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED)
+            self._csv_file = io.StringIO()
+            self._lesion_csv_file = io.StringIO()
+        else:
+            image_folder = self.path / "modified_images"
+            (image_folder if save_images else self.path).mkdir(
+                parents=True, exist_ok=True
+            )
+            self._zip = None
+            self._csv_file = open(self.path / "results.csv", "w")
+            self._lesion_csv_file = None
+        self._csv_writer = csv.DictWriter(self._csv_file, fieldnames=CSV_FIELDNAMES)
+        self._csv_writer.writeheader()
+        self._lesion_csv_writer = None
+
+    def add(self, leaf: Leaf) -> LeafMetrics:
+        """
+        Writes a processed leaf and releases its images. Returns the leaf's metrics record.
+        """
+        record = LeafMetrics.from_leaf(leaf)
+        self.write(record, encode_leaf_images(leaf) if self.save_images else {})
+        leaf.release_images()
+        return record
+
+    def write(self, record: LeafMetrics, images: dict) -> None:
+        """
+        Writes a metrics record and its already encoded images, e.g. as returned by a worker process.
+        """
+        self._csv_writer.writerow(csv_row(record))
+        lesion_rows = lesion_csv_rows(record)
+        if lesion_rows:
+            self._lesion_writer().writerows(lesion_rows)
+        for file_name, data in images.items():
+            if self._zip is not None:
+                self._zip.writestr(
+                    f"modified_images/{file_name}",
+                    data,
+                    compress_type=zip_compression(file_name),
+                )
+            else:
+                (self.path / "modified_images" / file_name).write_bytes(data)
+        if self._zip is None:
+            self._csv_file.flush()
+        self.records.append(record)
+
+    def _lesion_writer(self) -> csv.DictWriter:
+        """
+        Returns the writer of lesions.csv, which is only created once a leaf with lesion features is written.
+        """
+        if self._lesion_csv_writer is None:
+            if self._lesion_csv_file is None:
+                self._lesion_csv_file = open(self.path / "lesions.csv", "w")
+            self._lesion_csv_writer = csv.DictWriter(
+                self._lesion_csv_file, fieldnames=LESION_CSV_FIELDNAMES
+            )
+            self._lesion_csv_writer.writeheader()
+        return self._lesion_csv_writer
+
+    def close(self) -> None:
+        if self._zip is not None:
+            self._zip.writestr("results.csv", self._csv_file.getvalue())
+            if self._lesion_csv_writer is not None:
+                self._zip.writestr("lesions.csv", self._lesion_csv_file.getvalue())
+            self._zip.writestr("profile.json", profile_json(self.records))
+            self._zip.close()
+        else:
+            self._csv_file.close()
+            if self._lesion_csv_file is not None:
+                self._lesion_csv_file.close()
+            (self.path / "profile.json").write_text(profile_json(self.records))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResultsArchive:
+    """
+    Builds the results zip archive of the app in memory, with the layout written by ResultsWriter.
+    The images of the leaves are encoded in parallel by the executor and written to the archive in order as they
+    are ready. Encoded images are kept until the result of their leaf changes, and the archive until any does.
+    """
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self._images = {}
+        self._archive = None
+
+    def build(self, leaves: list) -> bytes:
+        """
+        Returns the archive of the results of the leaves, only encoding the images of changed leaves.
+        """
+        revisions = [result_revision(leaf) for leaf in leaves]
+        if self._archive is not None and self._archive[0] == revisions:
+            return self._archive[1]
+
+        # Encode the images of new and changed leaves in the background
+        pending = {
+            leaf.key: self.executor.submit(encode_leaf_images, leaf)
+            for leaf, revision in zip(leaves, revisions)
+            if self._images.get(leaf.key, (None,))[0] != revision
+        }
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("results.csv", csv_text(leaves))
+            if any(leaf.label_features is not None for leaf in leaves):
+                archive.writestr("lesions.csv", lesion_csv_text(leaves))
+            archive.writestr("profile.json", profile_json(leaves))
+            for leaf, revision in zip(leaves, revisions):
+                if leaf.key in pending:
+                    self._images[leaf.key] = (revision, pending[leaf.key].result())
+                for file_name, data in self._images[leaf.key][1].items():
+                    archive.writestr(
+                        f"modified_images/{file_name}",
+                        data,
+                        compress_type=zip_compression(file_name),
+                    )
+
+        # Forget the images of leaves that are no longer shown
+        keys = {leaf.key for leaf in leaves}
+        self._images = {k: v for k, v in self._images.items() if k in keys}
+        self._archive = (revisions, buffer.getvalue())
+        return self._archive[1]
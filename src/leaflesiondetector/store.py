@@ -0,0 +1,151 @@
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+import numpy as np
+
+# The measurements stored for every leaf, with their SQLite column types
+METRIC_COLUMNS = {
+    "reference": "INTEGER",
+    "background_colour": "TEXT",
+    "leaf_area": "REAL",
+    "lesion_area": "REAL",
+    "lesion_area_percentage": "REAL",
+    "run_time": "REAL",
+    "minimum_lesion_area_value": "INTEGER",
+    "lesion_size_threshold": "REAL",
+    "average_lesion_size": "REAL",
+    "num_lesions": "INTEGER",
+    "min_lesion_size": "REAL",
+    "max_lesion_size": "REAL",
+}
+
+COLUMNS = {
+    "batch": "TEXT",
+    "recorded_at": "REAL",
+    "image": "TEXT",
+    "content_hash": "TEXT",
+    "disease": "TEXT",
+    "leaf_number": "TEXT",
+    **METRIC_COLUMNS,
+}
+
+
+def parse_name(name: str) -> tuple:
+    """
+    Returns the disease and leaf number of an image named <disease_name>_<leaf_number>..., or (None, None)
+    if the name does not follow that convention.
+    """
+    parts = Path(name).stem.split("_")
+    if len(parts) < 2 or not parts[0] or not parts[1]:
+        return None, None
+    return parts[0], parts[1]
+
+
+class ResultsStore:
+    """
+    A SQLite table of the measurements of every processed leaf, with the disease and leaf number parsed from
+    its name. The table is append-only: each batch of leaves is written in one transaction, and saving a leaf again
+    adds a new row, so past results are never rewritten. No images are stored, so the results of many past batches
+    can be aggregated without loading them.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+        with self._connect() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS results ({columns})")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_disease ON results (disease)"
+            )
+
+    def _connect(self) -> closing:
+        """
+        Returns a connection to the store that is closed at the end of the block it is used in.
+        """
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def save(self, leaves: list, batch: str = None) -> str:
+        """
+        Appends the current measurements of leaf objects or their LeafMetrics records to a batch. Returns the batch
+        id, a new unique one unless given.
+        """
+        batch = batch or uuid.uuid4().hex
+        # Later than any saved row even within the clock's resolution, so the revision always grows
+        recorded_at = max(time.time(), self.revision() + 1e-6)
+        rows = [
+            (
+                batch,
+                recorded_at,
+                leaf.name,
+                leaf.content_hash,
+                *parse_name(leaf.name),
+                *(_column_value(getattr(leaf, name)) for name in METRIC_COLUMNS),
+            )
+            for leaf in leaves
+        ]
+        placeholders = ", ".join("?" * len(COLUMNS))
+        # The connection's context commits the rows at once, or none of them on an error
+        with self._connect() as connection, connection:
+            connection.executemany(
+                f"INSERT INTO results ({', '.join(COLUMNS)}) VALUES ({placeholders})",
+                rows,
+            )
+        return batch
+
+    def revision(self) -> float:
+        """
+        Returns a number that grows whenever rows are saved, e.g. to invalidate cached aggregations.
+        """
+        with self._connect() as connection:
+            return (
+                connection.execute("SELECT MAX(recorded_at) FROM results").fetchone()[0]
+                or 0
+            )
+
+    def disease_summary(self, metric: str = "lesion_area_percentage") -> list:
+        """
+        Returns the number of leaves and the boxplot statistics of a metric for each disease, in disease order.
+        Each entry holds the disease, its count, its box as [lower, Q1, median, Q3, upper] and the values outside
+        the whiskers, which like ECharts' boxplot transform reach at most 1.5 times the interquartile range
+        beyond the quartiles. Leaves without a disease in their name are left out, and an image processed in several
+        batches, e.g. uploaded twice, only counts with its latest result.
+        """
+        if metric not in METRIC_COLUMNS:
+            raise ValueError(f"Unknown metric: {metric}")
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT disease, {metric} FROM ("
+                f"SELECT disease, {metric}, ROW_NUMBER() OVER ("
+                "PARTITION BY content_hash, image ORDER BY recorded_at DESC, rowid DESC"
+                ") AS age FROM results"
+                f") WHERE age = 1 AND disease IS NOT NULL AND {metric} IS NOT NULL "
+                f"ORDER BY disease, {metric}"
+            ).fetchall()
+
+        summary = []
+        for name, group in groupby(rows, key=itemgetter(0)):
+            group = np.array([value for _, value in group], dtype=float)
+            q1, median, q3 = np.percentile(group, [25, 50, 75])
+            bound = 1.5 * (q3 - q1)
+            lower, upper = max(group[0], q1 - bound), min(group[-1], q3 + bound)
+            summary.append(
+                {
+                    "disease": name,
+                    "count": len(group),
+                    "box": [float(v) for v in (lower, q1, median, q3, upper)],
+                    "outliers": group[(group < lower) | (group > upper)].tolist(),
+                }
+            )
+        return summary
+
+
+def _column_value(value):
+    """
+    Returns a measurement as a value SQLite can store, converting NumPy scalars to Python ones.
+    """
+    return value.item() if isinstance(value, np.generic) else value
@@ -1,30 +1,29 @@
 import streamlit as st
-from leaflesiondetector import lesion_detector
+from leaflesiondetector import ingest, lesion_detector
 
 import os
-import shutil
-from PIL import Image
 import time
-from pathlib import Path
-from leaflesiondetector.leaf import Leaf
+from leaflesiondetector.leaf import Leaf, LeafList
+from leaflesiondetector.cache import ResultCache
+from leaflesiondetector.results import ResultsArchive, result_revision
+from leaflesiondetector.store import ResultsStore
 
-import tempfile
-import time
-from streamlit_lottie import st_lottie_spinner
-import requests
-import json
-import csv
-from streamlit_image_coordinates import streamlit_image_coordinates
-from PIL import ImageDraw
-import numpy as np
-import plotly.express as px
+import multiprocessing
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 
-# Read in settings from JSON file
-with open("src/leaflesiondetector/settings.json") as f:
-    settings = json.load(f)
+# The Streamlit components, plotly and requests are imported in the functions that use them,
+# so importing this module, e.g. in a worker process, stays fast.
+settings = lesion_detector.settings
 
 
 def load_lottieurl(url: str):
+    import requests
+
     r = requests.get(url)
     if r.status_code != 200:
         return None
@@ -35,26 +34,7 @@ def apply_changes(leaf: Leaf, point: tuple[int, int]) -> None:
     """
     This function applies the changes to the image.
     """
-    # Image modification
-    draw = ImageDraw.Draw(leaf.modified_image)
-    class_value = leaf.labeled_pixels[point[1]][point[0]]
-    if class_value in [0, 1]:
-        return
-    x, y = np.where(leaf.labeled_pixels == class_value)
-    draw.point(list(zip(y, x)), fill=(0, 0, 0))
-
-    # Values modification
-    leaf.lesion_area -= leaf.lesion_class_map[class_value]
-    leaf.lesion_class_map.pop(class_value)
-    leaf.lesion_area_percentage = 100 * leaf.lesion_area / leaf.leaf_area
-    if leaf.reference:
-        leaf.lesion_area_mm2 = (
-            leaf.lesion_area * settings["reference_area_mm"]
-        ) / leaf.reference_area
-    leaf.num_lesions -= 1
-    leaf.average_lesion_size = leaf.lesion_area / leaf.num_lesions
-    leaf.max_lesion_size = max(leaf.lesion_class_map.values())
-    leaf.min_lesion_size = min(leaf.lesion_class_map.values())
+    lesion_detector.remove_lesion(leaf, point)
 
 
 def maintain_results() -> None:
@@ -64,99 +44,30 @@ def maintain_results() -> None:
     st.session_state["render"] = True
 
 
-def write_csv(file: str, leaves: list) -> None:
-    """
-    This function writes the results of the image processing to a CSV file.
-    """
-    columns_format = dict(
-        name="Image",
-        lesion_area_percentage="Percentage area",
-        lesion_area_mm2="Percentage area mm2",
-        run_time="Run time (seconds)",
-        minimum_lesion_area_value="Intensity threshold",
-    )
-    with open(file, "w") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=[
-                "Image",
-                "Percentage area",
-                "Area",
-                "Run time (seconds)",
-                "Intensity threshold",
-                "Lesion size threshold",
-                "Average lesion size",
-                "Maximum lesion size",
-                "Minimum lesion size",
-                "Lesion map",
-            ],
-        )
-        writer.writeheader()
-        for leaf in leaves:
-            writer.writerow(
-                {
-                    "Image": leaf.name,
-                    "Percentage area": leaf.lesion_area_percentage,
-                    "Area": str(leaf.lesion_area) + " mm2"
-                    if leaf.reference
-                    else str(leaf.lesion_area) + " px",
-                    "Run time (seconds)": leaf.run_time,
-                    "Intensity threshold": leaf.minimum_lesion_area_value,
-                    "Lesion size threshold": leaf.lesion_size_threshold,
-                    "Average lesion size": leaf.average_lesion_size,
-                    "Maximum lesion size": leaf.max_lesion_size,
-                    "Minimum lesion size": leaf.min_lesion_size,
-                    "Lesion map": list(leaf.lesion_class_map.values()),
-                }
-            )
-
-
 def download_results(leaves: list) -> None:
     """
     This function downloads the results of the image processing.
+    The archive is built in memory and only rebuilt when a result has changed since the last rerun.
     """
-    # Create a temporary directory to store the results
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        os.mkdir(tmpdirname + "/modified_images/")
-        write_csv(f"{tmpdirname}/results.csv", leaves)
-        for leaf in leaves:
-            leaf.modified_image.save(
-                tmpdirname
-                + "/modified_images/"
-                + f"{Path(leaf.name).stem}_modified{Path(leaf.name).suffix}"
-            )
-            leaf.leaf_binary.save(
-                tmpdirname
-                + "/modified_images/"
-                + f"{Path(leaf.name).stem}_leaf_binary{Path(leaf.name).suffix}"
-            )
-            leaf.leaf_outline_binary.save(
-                tmpdirname
-                + "/modified_images/"
-                + f"{Path(leaf.name).stem}_leaf_outline_binary{Path(leaf.name).suffix}"
-            )
-            leaf.lesion_binary.save(
-                tmpdirname
-                + "/modified_images/"
-                + f"{Path(leaf.name).stem}_lesion_binary{Path(leaf.name).suffix}"
-            )
-        shutil.make_archive("results", "zip", tmpdirname)
+    if "results_archive" not in st.session_state:
+        st.session_state["results_archive"] = ResultsArchive(io_executor())
 
     # Add a download button
-    with open("results.zip", "rb") as fp:
-        st.download_button(
-            label="Download Results",
-            data=fp,
-            file_name="results.zip",
-            mime="application/zip",
-            on_click=maintain_results,
-        )
+    st.download_button(
+        label="Download Results",
+        data=st.session_state["results_archive"].build(leaves),
+        file_name="results.zip",
+        mime="application/zip",
+        on_click=maintain_results,
+    )
 
 
 def process_uploaded_images(leaves: list) -> None:
     """
     This function processes the uploaded images.
     """
+    from streamlit_lottie import st_lottie_spinner
+
     my_bar = st.progress(0, "Running...")
     start_time = time.time()
     with st_lottie_spinner(
@@ -165,21 +76,30 @@ def process_uploaded_images(leaves: list) -> None:
         speed=0.5,
         loop=True,
     ):
-        for i, leaf in enumerate(leaves):
-            lesion_detector.background_detector(leaf)
-            leaf.minimum_lesion_area_value = settings[leaf.background_colour][
-                "low_intensity"
-            ]
-            my_bar.progress((i + 1) / len(leaves), f"{leaf.name}...")
-            lesion_detector.process_image(leaf)
-            if leaf.lesion_area_percentage > 3.5:
-                leaf.minimum_lesion_area_value = settings[leaf.background_colour][
-                    "high_intensity"
-                ]
-                lesion_detector.process_image(leaf)
+        futures = {
+            upload_executor().submit(
+                lesion_detector.measure_leaves,
+                leaf,
+                st.session_state.get("multi_leaf", False),
+                result_cache(),
+            ): i
+            for i, leaf in enumerate(leaves)
+        }
+        results = [None] * len(leaves)
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            results[i] = future.result()
+            my_bar.progress(done / len(leaves), f"{leaves[i].name}...")
+        # Keep the upload order, with a result per leaf found in each image
+        empty_images = [
+            leaf.name for leaf, result in zip(leaves, results) if not result
+        ]
+        leaves[:] = [leaf for result in results for leaf in result]
         end_time = time.time()
     st.markdown(f"#### Total run time: {'%.2f'%(end_time - start_time)} seconds")
     my_bar.empty()
+    for name in empty_images:
+        st.error(f"No leaf found in {name}.")
 
     st.session_state["process"] = False
     st.session_state["render"] = True
@@ -188,8 +108,31 @@ def process_uploaded_images(leaves: list) -> None:
 def display_results(leaves: list) -> None:
     """
     This function displays the results of the image processing.
+    Leaves with a full resolution refinement running show their preview until it finishes.
     """
-    for leaf in leaves:
+    import plotly.express as px
+    from streamlit_image_coordinates import streamlit_image_coordinates
+
+    refinements = st.session_state["refinements"]
+    # Forget the refinements of leaves that are no longer shown, e.g. from an earlier upload
+    keys = {leaf.key for leaf in leaves}
+    for key in [key for key in refinements if key not in keys]:
+        del refinements[key]
+    for i, leaf in enumerate(leaves):
+        refinement = refinements.get(leaf.key)
+        if refinement is not None and refinement.done():
+            del refinements[leaf.key]
+            try:
+                leaves[i] = leaf = refinement.result()
+            except Exception as error:
+                # Process the leaf at full resolution here instead, so its preview is not kept
+                st.error(
+                    f"Refining {leaf.name} failed ({type(error).__name__}: {error}), processing it again."
+                )
+                lesion_detector.process_image(leaf)
+                leaf.drop_caches()
+        result = leaf.preview if leaf.key in refinements else leaf
+
         cols = st.columns([1, 1.5, 1])
         cols[0].image(
             leaf.img,
@@ -197,9 +140,9 @@ def display_results(leaves: list) -> None:
         )
         with cols[1]:
             value = streamlit_image_coordinates(
-                leaf.modified_image,
-                width=leaf.modified_image.size[0] / 4,
-                height=leaf.modified_image.size[1] / 4,
+                result.modified_image,
+                width=leaf.img.size[0] / 4,
+                height=leaf.img.size[1] / 4,
                 key=leaf.key + "_image",
             )
             if value is not None:
@@ -207,22 +150,44 @@ def display_results(leaves: list) -> None:
                     st.session_state[leaf.key + "_image"]["x"] * 4,
                     st.session_state[leaf.key + "_image"]["y"] * 4,
                 )
+                # Clicks on a preview are recorded but ignored, so the component's last click
+                # is not applied to the refined leaf once it replaces the preview
                 if (point, leaf.key) not in st.session_state["points"]:
                     st.session_state["points"].append((point, leaf.key))
-                    apply_changes(leaf, point)
-                    st.experimental_rerun()
+                    if result is leaf:
+                        apply_changes(leaf, point)
+                        st.experimental_rerun()
+            undo_col, redo_col = st.columns(2)
+            undo_col.button(
+                "Undo",
+                key=leaf.key + "_undo",
+                disabled=result is not leaf or not leaf.edits,
+                on_click=lesion_detector.undo_edit,
+                args=[leaf],
+                use_container_width=True,
+            )
+            redo_col.button(
+                "Redo",
+                key=leaf.key + "_redo",
+                disabled=result is not leaf or not leaf.undone_edits,
+                on_click=lesion_detector.redo_edit,
+                args=[leaf],
+                use_container_width=True,
+            )
 
         cols[2].markdown(
             f"""
             #### {leaf.name}\n 
-            ### {'%.2f'%leaf.lesion_area_percentage} %\n 
-            ### {'%.2f'%leaf.lesion_area+" mm²" if leaf.reference else ""}
-            #### {leaf.num_lesions} lesions
-            **Average lesion size:** {'%.5f'%leaf.average_lesion_size} {"mm²" if leaf.reference else "pixels"}\n
-            **Maximum lesion size:** {'%.5f'%leaf.max_lesion_size} {"mm²" if leaf.reference else "pixels"}\n
-            **Minimum lesion size:** {'%.5f'%leaf.min_lesion_size} {"mm²" if leaf.reference else "pixels"}\n
-            {'%.2f'%leaf.run_time} seconds"""
+            ### {'%.2f'%result.lesion_area_percentage} %\n 
+            ### {'%.2f'%result.lesion_area+" mm²" if result.reference else ""}
+            #### {result.num_lesions} lesions
+            **Average lesion size:** {'%.5f'%result.average_lesion_size} {"mm²" if result.reference else "pixels"}\n
+            **Maximum lesion size:** {'%.5f'%result.max_lesion_size} {"mm²" if result.reference else "pixels"}\n
+            **Minimum lesion size:** {'%.5f'%result.min_lesion_size} {"mm²" if result.reference else "pixels"}\n
+            {'%.2f'%result.run_time} seconds"""
         )
+        if result is not leaf:
+            cols[2].caption("Preview, refining at full resolution...")
 
         with cols[2].expander("Settings"):
             st.number_input(
@@ -249,45 +214,109 @@ def display_results(leaves: list) -> None:
                 ["Black", "White"],
                 index=["Black", "White"].index(leaf.background_colour),
                 key=leaf.key + "_colour",
+                # The leaf area of a leaf cropped from a tray can only be measured on the whole tray
+                disabled=leaf.bbox is not None,
                 on_change=update_result,
                 args=[leaf],
             )
 
         cols[2].plotly_chart(
-            px.histogram(list(leaf.lesion_class_map.values()), log_y=True),
+            px.histogram(list(result.lesion_class_map.values()), log_y=True),
             use_container_width=True,
         )
 
+    # Poll the background refinements until all of them have replaced their previews
+    if refinements:
+        time.sleep(0.5)
+        st.experimental_rerun()
+
+
+def store_results(leaf_list: LeafList) -> None:
+    """
+    This function saves the results of the leaves that changed since the last rerun to the results store,
+    e.g. after new settings or removed lesions, so the Visualization page shows the current results.
+    """
+    stored = st.session_state.get("stored_revisions", {})
+    revisions = {leaf.key: result_revision(leaf) for leaf in leaf_list.leaves}
+    changed = [
+        leaf for leaf in leaf_list.leaves if stored.get(leaf.key) != revisions[leaf.key]
+    ]
+    if changed:
+        results_store().save(changed, leaf_list.batch)
+    st.session_state["stored_revisions"] = revisions
+
 
 def update_result(leaf) -> None:
     leaf.minimum_lesion_area_value = st.session_state[leaf.key + "_intensity"]
     leaf.background_colour = st.session_state[leaf.key + "_colour"]
     leaf.lesion_size_threshold = st.session_state[leaf.key + "_lesion_size"]
-    lesion_detector.process_image(leaf)
+    if settings["preview_scale"] > 1 and leaf.bbox is None:
+        # Show a downsampled preview straight away and refine it at full resolution in the background.
+        # Leaves cropped from a tray only rerun the lesion stages, which need no preview.
+        lesion_detector.process_preview(leaf, settings["preview_scale"])
+        st.session_state["refinements"][leaf.key] = refinement_executor().submit(
+            lesion_detector.process_copy, leaf
+        )
+    else:
+        lesion_detector.process_image(leaf)
+        leaf.drop_caches()
+
+
+@st.cache_resource
+def upload_executor() -> Executor:
+    """
+    This function returns the pool that processes uploaded images, shared by every session.
+    """
+    workers = settings["app_workers"] or os.cpu_count()
+    if settings["app_executor"] == "thread":
+        return ThreadPoolExecutor(max_workers=workers)
+    # Spawn the workers, as forking the multithreaded Streamlit server is unsafe
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+@st.cache_resource
+def io_executor() -> ThreadPoolExecutor:
+    """
+    This function returns the thread pool that decodes the uploads and encodes the results archives, shared by every session.
+    """
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+@st.cache_resource
+def result_cache() -> ResultCache:
+    """
+    This function returns the on-disk cache of processed images shared by every session.
+    """
+    return ResultCache(settings["cache_folder_path"], settings["cache_max_size_mb"])
+
+
+@st.cache_resource
+def results_store() -> ResultsStore:
+    """
+    This function returns the store that the measurements of every processed batch are saved to.
+    """
+    return ResultsStore(settings["results_store_path"])
+
+
+@st.cache_resource
+def refinement_executor() -> ThreadPoolExecutor:
+    """
+    This function returns the thread pool that refines previews at full resolution in the background.
+    """
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
 
 
 def save_uploaded_files(uploaded_files: list, leaves: list) -> None:
     """
-    This function saves the uploaded files to disk.
+    This function reads the uploaded files into leaf objects, decoding them in parallel.
     """
 
-    for uploaded_file in uploaded_files:
+    valid_leaves, invalid_files = ingest.load_leaves(uploaded_files, io_executor())
+    leaves.extend(valid_leaves)
+    for name in invalid_files:
         image_upload_status = st.empty()
-        # Check if the image is usable
-        try:
-            Image.open(uploaded_file)
-        except:
-            image_upload_status.error(f"{uploaded_file.name} is not a valid image.")
-            time.sleep(2)  # For Streamlit UI purposes
-            image_upload_status.empty()
-            return
-
-        # Save the file to disk
-        with Image.open(uploaded_file) as img:
-            leaves.append(
-                Leaf(
-                    f"{uploaded_file.name}_{int(time.time_ns())}",
-                    uploaded_file.name,
-                    img.copy(),
-                )
-            )
+        image_upload_status.error(f"{name} is not a valid image.")
+        time.sleep(2)  # For Streamlit UI purposes
+        image_upload_status.empty()
@@ -1,28 +1,35 @@
 import streamlit as st
+from leaflesiondetector.store import ResultsStore
+from leaflesiondetector.ui_functions import results_store
 
-if len(st.session_state["leaves"].leaves) == 0 or "leaves" not in st.session_state:
-    st.warning("Please upload an image set first")
-    st.stop()
 
-diseases = {}
-boxplot_data = [[]]
+@st.cache_data(show_spinner=False)
+def disease_summary(path: str, revision: float) -> list:
+    """
+    This function returns the count and boxplot statistics of the lesion area percentage of each disease in the
+    results store at path. The result is cached until the revision of the store changes.
+    """
+    return ResultsStore(path).disease_summary()
 
-try:
-    for leaf in st.session_state["leaves"].leaves:
-        disease_name, leaf_number, _ = leaf.name.split("_")
-        diseases[f"{disease_name}"] = diseases.get(
-            disease_name, {"count": 0, "measurements": [], "leaves": {}}
-        )
-        diseases[disease_name]["count"] += 1
-        diseases[disease_name]["measurements"].append(leaf.lesion_area_percentage)
 
-    pie_data = [{"value": v["count"], "name": k} for k, v in diseases.items()]
-    boxplot_data = [v["measurements"] for v in diseases.values()]
-except:
-    st.markdown(
-        """
-    #### Please upload files with the following naming convention:
-    `<disease_name>_<leaf_number>.<file_extension>`
+def load_disease_summary() -> list:
     """
-    )
-    st.stop()
+    This function returns the disease summary of every batch in the results store, stopping the page with a message
+    if there is nothing to show.
+    """
+    store = results_store()
+    revision = store.revision()
+    if revision == 0:
+        st.warning("Please upload an image set first")
+        st.stop()
+
+    summary = disease_summary(str(store.path), revision)
+    if not summary:
+        st.markdown(
+            """
+        #### Please upload files with the following naming convention:
+        `<disease_name>_<leaf_number>.<file_extension>`
+        """
+        )
+        st.stop()
+    return summary
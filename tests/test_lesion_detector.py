@@ -4,13 +4,44 @@ from leaflesiondetector.lesion_detector import (
     process_image,
     append_leaf_area_binary,
     append_lesion_area_binary,
+    filter_lesions,
+    measure_leaves,
+    median_filter_mask,
+    process_copy,
+    process_preview,
+    process_tray,
+    process_leaf,
+    redo_edit,
+    remove_lesion,
+    undo_edit,
 )
 from leaflesiondetector.leaf import Leaf
-from PIL import Image, ImageChops
+from PIL import Image, ImageChops, ImageFilter
+import numpy as np
 from pathlib import Path
 import tempfile
+import csv
+import sqlite3
+import io
+import json
+import zipfile
+import tracemalloc
+import copy
+import pickle
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 import time
 import leaflesiondetector
+from leaflesiondetector import cli
+from leaflesiondetector.results import ResultsArchive, ResultsWriter
+from leaflesiondetector.cache import ResultCache
+from leaflesiondetector.store import ResultsStore
+from leaflesiondetector.ingest import load_leaves
+from leaflesiondetector.config import SETTINGS_ENV_VAR, PipelineConfig, load_settings
+from leaflesiondetector.profiling import set_stage_profiler
+from skimage import measure
 
 
 @pytest.fixture()
@@ -36,6 +67,24 @@ def test_get_leaf_area_binary(base_leaf):
     assert isinstance(base_leaf.leaf_binary, Image.Image)
 
 
+# Unit test for the mask based leaf segmentation engine
+def test_mask_leaf_segmentation_matches_contours(base_leaf, monkeypatch):
+    """
+    Tests that the mask based leaf segmentation finds a leaf region
+    comparable to the contour based one.
+    """
+    append_leaf_area_binary(base_leaf)
+    contour_leaf_area = base_leaf.leaf_area
+
+    monkeypatch.setitem(
+        leaflesiondetector.lesion_detector.settings, "leaf_segmentation", "mask"
+    )
+    append_leaf_area_binary(base_leaf)
+    append_lesion_area_binary(base_leaf)
+    assert abs(base_leaf.leaf_area - contour_leaf_area) < 0.05 * contour_leaf_area
+    assert base_leaf.lesion_area > 0
+
+
 # Unit test for get_lesion_area_binary function
 def test_get_lesion_area_binary(base_leaf):
     """
@@ -47,6 +96,54 @@ def test_get_lesion_area_binary(base_leaf):
     assert isinstance(base_leaf.lesion_binary, Image.Image)
 
 
+# Unit test for the compact masks and labels on the Leaf object
+def test_leaf_stores_compact_masks(base_leaf):
+    """
+    Tests that the masks are stored as boolean arrays, the labels in a small
+    integer type, and that the binaries are still available as RGB images.
+    """
+    process_image(base_leaf)
+    assert base_leaf.leaf_mask.dtype == bool
+    assert base_leaf.leaf_outline_mask.dtype == bool
+    assert base_leaf.labeled_pixels.dtype == np.min_scalar_type(
+        len(base_leaf.label_sizes) - 1
+    )
+    assert base_leaf.leaf_binary.mode == "RGB"
+    assert np.array_equal(
+        np.asarray(base_leaf.leaf_binary).any(axis=2), base_leaf.leaf_mask
+    )
+
+
+# Unit test for the cached HSV conversion on the Leaf object
+def test_leaf_hsv_is_cached(base_leaf):
+    """
+    Tests that the HSV array is computed once, is read-only and is
+    recomputed when the leaf image is replaced.
+    """
+    hsv = base_leaf.hsv
+    assert hsv is base_leaf.hsv
+    assert not hsv.flags.writeable
+    base_leaf.img = base_leaf.img.transpose(Image.Transpose.ROTATE_90)
+    assert base_leaf.hsv is not hsv
+    assert base_leaf.hsv.shape == (hsv.shape[1], hsv.shape[0], 3)
+
+
+# Unit test for median_filter_mask function
+@pytest.mark.parametrize("size", [3, 25])
+def test_median_filter_mask_matches_pil(size):
+    """
+    Tests that the boolean median filter matches PIL's MedianFilter
+    on the equivalent black and white image, including at the borders.
+    """
+    rng = np.random.default_rng(0)
+    mask = rng.random((97, 131)) < 0.5
+    mask[10:50, :40] = True
+    expected = Image.fromarray(np.uint8(mask * 255)).filter(
+        ImageFilter.MedianFilter(size)
+    )
+    assert np.array_equal(median_filter_mask(mask, size), np.asarray(expected) == 255)
+
+
 # Unit test for process_image function
 def test_process_image(base_leaf):
     """
@@ -64,6 +161,625 @@ def test_process_image(base_leaf):
     )
 
 
+# Unit test for the lesion size filter and colour map
+def test_filter_lesions_colours_by_size():
+    """
+    Tests that lesions are filtered by size and coloured from yellow for the smallest
+    to red for the largest, and that a leaf without lesions does not fail.
+    """
+    labeled = np.zeros((20, 40), dtype=np.uint8)
+    labeled[:, 30:] = 1  # The background region
+    labeled[2:4, 2:4] = 2
+    labeled[2:8, 10:16] = 3
+    labeled[10:12, 2:12] = 4
+    labeled[15, 15] = 5
+    leaf = Leaf("synthetic", "synthetic", Image.new("RGB", (40, 20)))
+    leaf.labeled_pixels = labeled
+    leaf.label_sizes = np.bincount(labeled.ravel())
+    leaf.leaf_mask = np.ones(labeled.shape, dtype=bool)
+    leaf.leaf_area = labeled.size
+    leaf.lesion_size_threshold = 2.0
+    leaf.modified_image = leaf.img.copy()
+    filter_lesions(leaf)
+
+    assert leaf.lesion_class_map == {2: 4.0, 3: 36.0, 4: 20.0}
+    assert (leaf.num_lesions, leaf.min_lesion_size, leaf.max_lesion_size) == (3, 4, 36)
+    assert leaf.modified_image.getpixel((2, 2)) == (255, 255, 0)
+    assert leaf.modified_image.getpixel((10, 2)) == (255, 0, 0)
+    assert leaf.modified_image.getpixel((2, 10)) == (255, 127, 0)
+    assert leaf.modified_image.getpixel((15, 15)) == (0, 0, 0)
+    assert leaf.lesion_area == 60
+
+    leaf.lesion_size_threshold = 100.0
+    leaf.modified_image = leaf.img.copy()
+    filter_lesions(leaf)
+    assert leaf.lesion_class_map == {}
+    assert leaf.num_lesions == 0 and leaf.lesion_area == 0
+
+
+# Unit test for the incremental reprocessing in process_image
+def test_process_image_reuses_unchanged_stages(base_leaf):
+    """
+    Tests that changing the lesion size threshold only refilters the cached labels
+    and gives the same result as processing the image from scratch.
+    """
+    process_image(base_leaf)
+    leaf_mask = base_leaf.leaf_mask
+    labeled_pixels = base_leaf.labeled_pixels
+
+    base_leaf.lesion_size_threshold = 50.0
+    process_image(base_leaf)
+    assert base_leaf.leaf_mask is leaf_mask
+    assert base_leaf.labeled_pixels is labeled_pixels
+
+    fresh_leaf = Leaf(
+        "fresh",
+        "fresh",
+        base_leaf.img,
+        background_colour="Black",
+        minimum_lesion_area_value=120,
+        lesion_size_threshold=50.0,
+    )
+    process_image(fresh_leaf)
+    assert base_leaf.lesion_class_map == fresh_leaf.lesion_class_map
+    assert base_leaf.lesion_area == fresh_leaf.lesion_area
+    assert (
+        ImageChops.difference(
+            base_leaf.modified_image, fresh_leaf.modified_image
+        ).getbbox()
+        is None
+    )
+
+
+# Unit test for the intensity thresholds sharing one pass over the image
+def test_intensity_thresholds_share_lesion_values(base_leaf):
+    """
+    Tests that rethresholding a leaf at another intensity reuses its lesion values
+    and leaf boundary, and matches processing it at that intensity from scratch.
+    """
+    base_leaf.background_colour = "Black"
+    base_leaf.minimum_lesion_area_value = 120
+    process_image(base_leaf)
+    values = base_leaf.lesion_values
+    boundary = base_leaf.lesion_boundary
+
+    base_leaf.minimum_lesion_area_value = 140
+    process_image(base_leaf)
+    assert base_leaf.lesion_values is values
+    assert base_leaf.lesion_boundary is boundary
+
+    fresh_leaf = Leaf(
+        "fresh",
+        "fresh",
+        base_leaf.img,
+        background_colour="Black",
+        minimum_lesion_area_value=140,
+    )
+    process_image(fresh_leaf)
+    assert base_leaf.lesion_class_map == fresh_leaf.lesion_class_map
+    assert base_leaf.lesion_area == fresh_leaf.lesion_area
+
+    base_leaf.background_colour = "White"
+    process_image(base_leaf)
+    assert base_leaf.lesion_values is not values
+
+
+# Unit test for the tiled execution mode
+@pytest.mark.parametrize("leaf_segmentation", ["contour", "mask"])
+def test_tiled_processing_matches_full_image(base_leaf, monkeypatch, leaf_segmentation):
+    """
+    Tests that processing the image in strips with labels merged across
+    the seams gives the same results as a single full image pass.
+    """
+    monkeypatch.setitem(
+        leaflesiondetector.lesion_detector.settings,
+        "leaf_segmentation",
+        leaf_segmentation,
+    )
+    process_image(base_leaf)
+    tiled_leaf = Leaf(
+        "tiled",
+        "tiled",
+        base_leaf.img,
+        background_colour="Black",
+        minimum_lesion_area_value=120,
+    )
+    monkeypatch.setitem(leaflesiondetector.lesion_detector.settings, "tile_rows", 97)
+    process_image(tiled_leaf)
+
+    assert tiled_leaf.lesion_class_map == base_leaf.lesion_class_map
+    assert tiled_leaf.leaf_area == base_leaf.leaf_area
+    assert tiled_leaf.lesion_area == base_leaf.lesion_area
+    assert np.array_equal(tiled_leaf.labeled_pixels, base_leaf.labeled_pixels)
+    assert tiled_leaf._hsv is None
+
+
+# Unit test for the multi-leaf mode
+def test_process_tray_measures_each_leaf(base_leaf, monkeypatch):
+    """
+    Tests that every leaf on a tray image is cropped to its bounding box
+    and measured as if it had been processed on its own.
+    """
+    monkeypatch.setitem(
+        leaflesiondetector.lesion_detector.settings, "leaf_segmentation", "mask"
+    )
+    width, height = base_leaf.img.size
+    single = Image.new("RGB", (width + 200, height + 200))
+    single.paste(base_leaf.img, (100, 100))
+    tray = Image.new("RGB", (2 * width + 300, height + 200))
+    tray.paste(base_leaf.img, (100, 100))
+    tray.paste(base_leaf.img, (width + 200, 100))
+
+    single_leaf = Leaf("single", "single.jpeg", single)
+    process_leaf(single_leaf)
+    leaves = process_tray(Leaf("tray", "tray.jpeg", tray))
+    # Components without any pixel inside a leaf region cannot be assigned to a leaf
+    lesions_inside_leaf = set(
+        np.unique(single_leaf.labeled_pixels[single_leaf.leaf_mask])
+    ) & set(single_leaf.lesion_class_map)
+
+    assert [leaf.name for leaf in leaves] == ["tray_1.jpeg", "tray_2.jpeg"]
+    assert leaves[0].bbox[2] <= leaves[1].bbox[0]
+    for leaf in leaves:
+        assert leaf.img.size == (
+            leaf.bbox[2] - leaf.bbox[0],
+            leaf.bbox[3] - leaf.bbox[1],
+        )
+        assert leaf.leaf_area == single_leaf.leaf_area
+        assert leaf.lesion_area == single_leaf.lesion_area
+        assert leaf.num_lesions == len(lesions_inside_leaf)
+
+
+# Unit test for an image without any leaf in the multi-leaf mode
+def test_process_file_reports_image_without_leaf(tmp_path):
+    """
+    Tests that an image without any leaf gives no leaves in the multi-leaf mode,
+    and is reported as such instead of as an invalid image.
+    """
+    empty = Image.new("RGB", (60, 60))
+    assert process_tray(Leaf("empty", "empty.png", empty)) == []
+    empty.save(tmp_path / "empty.png")
+    assert cli.process_file(str(tmp_path / "empty.png"), multi_leaf=True) == (
+        "no leaf found",
+        [],
+    )
+
+
+# Unit test for reprocessing a leaf cropped from a tray
+def test_tray_leaf_reprocessing_keeps_results(base_leaf):
+    """
+    Tests that changing the intensity of a leaf cropped from a tray and setting it back
+    gives the results of the tray again without changing the other leaves, and that its leaf
+    area stage cannot rerun on the crop.
+    """
+    width, height = base_leaf.img.size
+    tray = Image.new("RGB", (2 * width + 300, height + 200))
+    tray.paste(base_leaf.img, (100, 100))
+    tray.paste(base_leaf.img, (width + 200, 100))
+    leaf, other_leaf = process_tray(Leaf("tray", "tray.jpeg", tray))
+    other_profile = copy.deepcopy(other_leaf.profile)
+    expected = (
+        leaf.leaf_area,
+        leaf.lesion_area,
+        leaf.num_lesions,
+        sorted(leaf.lesion_class_map.values()),
+    )
+
+    intensity = leaf.minimum_lesion_area_value
+    leaf.minimum_lesion_area_value = intensity + 5
+    process_image(leaf)
+    leaf.minimum_lesion_area_value = intensity
+    process_image(leaf)
+    assert (
+        leaf.leaf_area,
+        leaf.lesion_area,
+        leaf.num_lesions,
+        sorted(leaf.lesion_class_map.values()),
+    ) == expected
+    assert other_leaf.profile == other_profile
+
+    leaf.background_colour = "White"
+    with pytest.raises(ValueError):
+        process_image(leaf)
+
+
+# Unit test for processing uploads in a worker process, as the app does
+def test_measure_leaves_in_worker_process(base_leaf):
+    """
+    Tests that a leaf object processed in a separate process comes back
+    with the same results as one processed in this process.
+    """
+    local_leaf = copy.deepcopy(base_leaf)
+    process_leaf(local_leaf)
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        leaves = executor.submit(measure_leaves, base_leaf).result()
+
+    assert len(leaves) == 1
+    assert leaves[0].lesion_area == local_leaf.lesion_area
+    assert leaves[0].num_lesions == local_leaf.num_lesions
+    assert np.array_equal(leaves[0].labeled_pixels, local_leaf.labeled_pixels)
+    assert np.array_equal(leaves[0].leaf_mask, local_leaf.leaf_mask)
+
+
+# Unit test for the caches dropped from processed leaves
+def test_drop_caches_keeps_results(base_leaf):
+    """
+    Tests that a processed leaf without its recomputable caches is smaller when pickled
+    and gives the same results when its lesion stages rerun.
+    """
+    process_image(base_leaf)
+    outlined = np.asarray(base_leaf.outlined_image).copy()
+    modified = np.asarray(base_leaf.modified_image).copy()
+    size = len(pickle.dumps(base_leaf))
+    base_leaf.drop_caches()
+
+    assert base_leaf._hsv is None and base_leaf.lesion_values is None
+    assert base_leaf.lesion_boundary is None
+    assert len(pickle.dumps(base_leaf)) < size
+    intensity = base_leaf.minimum_lesion_area_value
+    base_leaf.minimum_lesion_area_value = intensity + 5
+    process_image(base_leaf)
+    base_leaf.minimum_lesion_area_value = intensity
+    process_image(base_leaf)
+    assert np.array_equal(np.asarray(base_leaf.outlined_image), outlined)
+    assert np.array_equal(np.asarray(base_leaf.modified_image), modified)
+
+
+# Unit test for the downsampled preview and the full resolution refinement
+def test_process_preview_approximates_full_resolution(base_leaf):
+    """
+    Tests that the preview measures areas in full resolution pixels and
+    that refining a copy leaves the original leaf untouched.
+    """
+    process_image(base_leaf)
+    preview = process_preview(base_leaf, 4)
+    assert preview.modified_image.size == base_leaf.img.reduce(4).size
+    assert preview.leaf_area == pytest.approx(base_leaf.leaf_area, rel=0.05)
+
+    lesion_area = base_leaf.lesion_area
+    base_leaf.lesion_size_threshold = 50.0
+    refined = process_copy(base_leaf)
+    assert base_leaf.lesion_area == lesion_area
+    assert refined.leaf_mask is base_leaf.leaf_mask
+    assert refined.lesion_size_threshold == 50.0
+    assert refined.lesion_values is None and refined._hsv is None
+
+
+# Unit test for removing a clicked lesion
+def test_remove_lesion_updates_statistics(base_leaf):
+    """
+    Tests that removing a lesion blacks out its pixels and updates the
+    statistics to match the remaining lesions.
+    """
+    process_image(base_leaf)
+    class_value = max(base_leaf.lesion_class_map, key=base_leaf.lesion_class_map.get)
+    y, x = np.argwhere(base_leaf.labeled_pixels == class_value)[0]
+    remaining = dict(base_leaf.lesion_class_map)
+    remaining.pop(class_value)
+
+    assert remove_lesion(base_leaf, (x, y))
+    assert not remove_lesion(base_leaf, (x, y))
+    pixels = np.asarray(base_leaf.modified_image)
+    assert not pixels[base_leaf.labeled_pixels == class_value].any()
+    assert base_leaf.num_lesions == len(remaining)
+    assert base_leaf.max_lesion_size == max(remaining.values())
+    assert base_leaf.min_lesion_size == min(remaining.values())
+    assert base_leaf.average_lesion_size == pytest.approx(
+        np.mean(list(remaining.values()))
+    )
+
+
+# Unit test for the lesion edit log
+def test_undo_redo_and_replay_lesion_edits(base_leaf):
+    """
+    Tests that undoing a removal restores the overlay and statistics exactly,
+    and that the edit log is replayed when the image is reprocessed.
+    """
+    process_image(base_leaf)
+    modified_image = base_leaf.modified_image.copy()
+    lesion_class_map = dict(base_leaf.lesion_class_map)
+    statistics = (base_leaf.lesion_area, base_leaf.max_lesion_size)
+    class_value = max(lesion_class_map, key=lesion_class_map.get)
+    y, x = np.argwhere(base_leaf.labeled_pixels == class_value)[0]
+
+    remove_lesion(base_leaf, (x, y))
+    assert undo_edit(base_leaf).class_value == class_value
+    assert undo_edit(base_leaf) is None
+    assert base_leaf.lesion_class_map == lesion_class_map
+    assert (base_leaf.lesion_area, base_leaf.max_lesion_size) == pytest.approx(
+        statistics
+    )
+    assert (
+        ImageChops.difference(base_leaf.modified_image, modified_image).getbbox()
+        is None
+    )
+
+    assert redo_edit(base_leaf).point == (x, y)
+    base_leaf.lesion_size_threshold = 50.0
+    process_image(base_leaf)
+    assert [edit.point for edit in base_leaf.edits] == [(x, y)]
+    assert base_leaf.labeled_pixels[y, x] not in base_leaf.lesion_class_map
+
+
+# Unit test for the per stage profile
+def test_process_image_records_stage_profile(base_leaf):
+    """
+    Tests that each stage records its timings and peak memory on the leaf
+    and is passed to a plugged in external profiler.
+    """
+    profiled_stages = []
+    set_stage_profiler(
+        lambda stage, leaf: profiled_stages.append(stage) or nullcontext()
+    )
+    tracemalloc.start()
+    try:
+        process_image(base_leaf)
+    finally:
+        tracemalloc.stop()
+        set_stage_profiler(None)
+
+    stages = [
+        "append_reference_area_binary",
+        "append_leaf_area_binary",
+        "append_lesion_area_binary",
+        "segment_lesions",
+    ]
+    assert set(stages) <= set(profiled_stages)
+    for stage in stages:
+        assert base_leaf.profile[stage]["calls"] == 1
+        assert base_leaf.profile[stage]["wall_time"] > 0
+        assert base_leaf.profile[stage]["peak_memory"] > 0
+
+
+# Unit test for the on-disk result cache
+def test_result_cache_restores_results(base_leaf, tmp_path):
+    """
+    Tests that a cached result is restored exactly on a new leaf with the same
+    image and settings, and that entries are evicted beyond the size limit.
+    """
+    cache = ResultCache(tmp_path, 100)
+    process_image(base_leaf, cache)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    cached_leaf = Leaf(
+        "cached",
+        "cached",
+        base_leaf.img.copy(),
+        background_colour="Black",
+        minimum_lesion_area_value=120,
+    )
+    process_image(cached_leaf, cache)
+    assert cached_leaf.lesion_class_map == base_leaf.lesion_class_map
+    assert cached_leaf.leaf_area == base_leaf.leaf_area
+    assert np.array_equal(cached_leaf.labeled_pixels, base_leaf.labeled_pixels)
+    for image in ("modified_image", "outlined_image", "leaf_binary", "lesion_binary"):
+        assert (
+            ImageChops.difference(
+                getattr(cached_leaf, image), getattr(base_leaf, image)
+            ).getbbox()
+            is None
+        )
+
+    ResultCache(tmp_path, 0).evict()
+    assert len(list(tmp_path.glob("*.npz"))) == 0
+
+
+# Unit test for storing the same result from several threads
+def test_result_cache_stores_concurrently(base_leaf, tmp_path):
+    """
+    Tests that threads sharing a cache can process identical images at once,
+    leaving a single entry and no temporary files behind.
+    """
+    cache = ResultCache(tmp_path, 100)
+    img = base_leaf.img.reduce(4)
+    leaves = [
+        Leaf(str(i), f"{i}.jpeg", img.copy(), background_colour="Black")
+        for i in range(6)
+    ]
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        futures = [
+            executor.submit(measure_leaves, leaf, False, cache) for leaf in leaves
+        ]
+        results = [future.result() for future in futures]
+
+    assert len({result[0].lesion_area for result in results}) == 1
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    assert len(list(tmp_path.glob("*.tmp"))) == 0
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "L"])
+def test_result_cache_restores_other_modes(base_leaf, tmp_path, mode):
+    """
+    Tests that images which are not RGB are cached and restored in their own mode.
+    """
+    cache = ResultCache(tmp_path, 100)
+    img = base_leaf.img.convert(mode)
+    leaves = [
+        Leaf(
+            name,
+            name,
+            img.copy(),
+            background_colour="Black",
+            minimum_lesion_area_value=120,
+        )
+        for name in ("uncached", "stored", "cached")
+    ]
+    process_image(leaves[0])
+    process_image(leaves[1], cache)
+    process_image(leaves[2], cache)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    for leaf in leaves[1:]:
+        assert leaf.lesion_area == leaves[0].lesion_area
+        for image in ("modified_image", "outlined_image"):
+            assert getattr(leaf, image).mode == getattr(leaves[0], image).mode
+            assert (
+                ImageChops.difference(
+                    getattr(leaf, image), getattr(leaves[0], image)
+                ).getbbox()
+                is None
+            )
+
+
+# Unit test for the streaming results writer
+def test_results_writer_streams_to_zip(base_leaf, tmp_path):
+    """
+    Tests that the results writer stores a leaf's images and CSV row
+    in the archive and releases the images held by the leaf.
+    """
+    base_leaf.name = "test.jpeg"
+    process_image(base_leaf)
+    with ResultsWriter(tmp_path / "results.zip") as writer:
+        record = writer.add(base_leaf)
+
+    assert base_leaf.modified_image is None and base_leaf.img is None
+    assert record.lesion_area == base_leaf.lesion_area
+    with zipfile.ZipFile(tmp_path / "results.zip") as archive:
+        names = archive.namelist()
+        assert "results.csv" in names
+        assert "profile.json" in names
+        assert "modified_images/test_modified.jpeg" in names
+        assert "modified_images/test_lesion_binary.jpeg" in names
+
+
+# Unit test for the per lesion feature table
+def test_lesion_features_match_regionprops(base_leaf, tmp_path):
+    """
+    Tests that the lesion features computed while labeling match skimage's regionprops,
+    follow removed lesions and are written to lesions.csv next to results.csv.
+    """
+    base_leaf.name = "test.jpeg"
+    config = dataclasses.replace(PipelineConfig.from_settings(), lesion_features=True)
+    process_image(base_leaf, config=config)
+    features = base_leaf.lesion_features
+    labels = features["label"]
+    assert list(labels) == sorted(base_leaf.lesion_class_map)
+    assert np.allclose(features["area"], list(base_leaf.lesion_class_map.values()))
+
+    lesions = np.where(
+        np.isin(base_leaf.labeled_pixels, labels), base_leaf.labeled_pixels, 0
+    )
+    expected = measure.regionprops_table(
+        lesions,
+        intensity_image=base_leaf.hsv[:, :, 0],
+        properties=("centroid", "bbox", "eccentricity", "intensity_mean"),
+    )
+    assert np.allclose(features["centroid_y"], expected["centroid-0"])
+    assert np.allclose(features["centroid_x"], expected["centroid-1"])
+    assert np.array_equal(features["top"], expected["bbox-0"])
+    assert np.array_equal(features["left"], expected["bbox-1"])
+    assert np.array_equal(features["bottom"], expected["bbox-2"])
+    assert np.array_equal(features["right"], expected["bbox-3"])
+    assert np.allclose(features["eccentricity"], expected["eccentricity"], atol=1e-4)
+    assert np.allclose(features["mean_hue"], expected["intensity_mean"])
+    lesion = np.pad(base_leaf.labeled_pixels == labels[0], 1)
+    edges = np.sum(lesion[:, 1:] != lesion[:, :-1]) + np.sum(lesion[1:] != lesion[:-1])
+    assert features["perimeter"][0] == edges
+
+    # Tiling gives the same features without converting the whole image to HSV
+    tiled_leaf = Leaf("tiled", "tiled.jpeg", base_leaf.img.copy())
+    tiled_leaf.background_colour = base_leaf.background_colour
+    tiled_leaf.minimum_lesion_area_value = base_leaf.minimum_lesion_area_value
+    process_image(tiled_leaf, config=dataclasses.replace(config, tile_rows=97))
+    assert tiled_leaf._hsv is None
+    for name, column in tiled_leaf.lesion_features.items():
+        assert np.allclose(column, features[name])
+
+    rows, cols = np.nonzero(base_leaf.labeled_pixels == labels[0])
+    remove_lesion(base_leaf, (cols[0], rows[0]))
+    assert labels[0] not in base_leaf.lesion_features["label"]
+    with ResultsWriter(tmp_path) as writer:
+        writer.add(base_leaf)
+    with open(tmp_path / "lesions.csv") as f:
+        assert len(list(csv.DictReader(f))) == len(labels) - 1
+
+
+# Unit test for the results store of the Visualization page
+def test_results_store_aggregates_batches(tmp_path):
+    """
+    Tests that batches saved to the results store are counted and summarised per disease,
+    with the same quartiles as NumPy, that leaves without a disease in their name are left out,
+    and that saving an image again appends its new result without counting it twice.
+    """
+    values = {"Xg": [1.0, 2.0, 3.0, 4.0, 50.0], "Bs": [5.0, 6.0]}
+    leaves = [
+        Leaf(
+            f"{disease}_{i}",
+            f"{disease}_{i:02d}_post.jpg",
+            Image.new("RGB", (2, 2), (i, len(disease), 0)),
+        )
+        for disease in values
+        for i in range(len(values[disease]))
+    ]
+    for leaf in leaves:
+        disease, number = leaf.name.split("_")[:2]
+        leaf.lesion_area_percentage = np.float64(values[disease][int(number)])
+
+    store = ResultsStore(tmp_path / "results.sqlite")
+    assert store.revision() == 0
+    batch = store.save(leaves[:3])
+    revision = store.revision()
+    unnamed = Leaf("unnamed", "unnamed.jpg", Image.new("RGB", (2, 2)))
+    ResultsStore(tmp_path / "results.sqlite").save(leaves[3:] + [unnamed])
+    assert store.revision() > revision
+
+    summary = store.disease_summary()
+    assert [(v["disease"], v["count"]) for v in summary] == [("Bs", 2), ("Xg", 5)]
+    q1, median, q3 = np.percentile(values["Xg"], [25, 50, 75])
+    assert summary[1]["box"] == [1.0, q1, median, q3, q3 + 1.5 * (q3 - q1)]
+    assert summary[1]["outliers"] == [50.0]
+
+    # A changed leaf and a re-upload add rows, and only the latest result of an image counts
+    revision = store.revision()
+    leaves[0].lesion_area_percentage = np.float64(7.0)
+    assert store.save(leaves[:1], batch) == batch
+    assert store.revision() > revision
+    leaves[5].lesion_area_percentage = np.float64(8.0)
+    store.save(leaves[5:])
+    summary = store.disease_summary()
+    assert [(v["disease"], v["count"]) for v in summary] == [("Bs", 2), ("Xg", 5)]
+    assert summary[0]["box"][2] == 7.0
+    q1, median, q3 = np.percentile([7.0, 2.0, 3.0, 4.0, 50.0], [25, 50, 75])
+    assert summary[1]["box"][1:4] == [q1, median, q3]
+    with sqlite3.connect(tmp_path / "results.sqlite") as connection:
+        assert connection.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 11
+
+
+# Unit test for the app's results archive
+def test_results_archive_reencodes_changed_leaves_only(base_leaf):
+    """
+    Tests that the archive stores the encoded images without recompressing them,
+    is reused while no result changes and only re-encodes the leaves that changed.
+    """
+    leaves = [copy.deepcopy(base_leaf) for _ in range(2)]
+    for i, leaf in enumerate(leaves):
+        leaf.key, leaf.name = f"leaf{i}", f"leaf{i}.jpeg"
+        process_image(leaf)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results_archive = ResultsArchive(executor)
+        data = results_archive.build(leaves)
+        assert results_archive.build(leaves) is data
+
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            info = archive.getinfo("modified_images/leaf0_modified.jpeg")
+            assert info.compress_type == zipfile.ZIP_STORED
+            assert archive.read("results.csv").decode().count("leaf") == 2
+            unchanged_image = archive.read("modified_images/leaf1_modified.jpeg")
+
+        leaves[0].lesion_size_threshold = 50.0
+        process_image(leaves[0])
+        encoded = results_archive._images["leaf1"]
+        changed_data = results_archive.build(leaves)
+        assert changed_data != data
+        assert results_archive._images["leaf1"] is encoded
+        with zipfile.ZipFile(io.BytesIO(changed_data)) as archive:
+            assert (
+                archive.read("modified_images/leaf1_modified.jpeg") == unchanged_image
+            )
+
+
 # Integration test
 @pytest.mark.parametrize("image_name", os.listdir("./tests/fixtures/input_images/"))
 def test_pipeline_produces_expected_output(image_name, tmp_path):
@@ -125,3 +841,165 @@ def test_pipeline_produces_expected_output(image_name, tmp_path):
         is None
     )
     assert leaf_area_matches and lesion_area_matches
+
+
+# Unit test for reading uploaded images
+def test_load_leaves_decodes_upright_images(tmp_path):
+    """
+    Tests that images are decoded upright with their DPI kept, in parallel and in order,
+    and that invalid files are reported.
+    """
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    Image.new("RGB", (64, 32), "green").save(
+        tmp_path / "rotated.jpg", dpi=(300, 300), exif=exif
+    )
+    (tmp_path / "broken.jpg").write_bytes(b"not an image")
+    files = [tmp_path / "rotated.jpg", tmp_path / "broken.jpg"]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        leaves, invalid_files = load_leaves(files, executor)
+        assert invalid_files == ["broken.jpg"]
+        assert [leaf.name for leaf in leaves] == ["rotated.jpg"]
+        assert leaves[0].img.size == (32, 64)
+        assert leaves[0].dpi == (300, 300)
+
+
+# Unit test for the settings loader
+def test_load_settings_from_package_or_override(tmp_path, monkeypatch):
+    """
+    Tests that the settings are read from the package whatever the working directory,
+    that callers get their own copy, and that another file can be used instead.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv(SETTINGS_ENV_VAR, raising=False)
+    settings = load_settings()
+    assert settings["Black"]["low_intensity"] == 120
+    settings["Black"]["low_intensity"] = 0
+    assert load_settings()["Black"]["low_intensity"] == 120
+
+    override_path = tmp_path / "settings.json"
+    override_path.write_text(json.dumps({**settings, "tile_rows": 64}))
+    assert load_settings(override_path)["tile_rows"] == 64
+    monkeypatch.setenv(SETTINGS_ENV_VAR, str(override_path))
+    assert load_settings()["tile_rows"] == 64
+
+
+# Unit test for processing leaves with their own config
+def test_leaves_processed_with_own_config(base_leaf, monkeypatch, tmp_path):
+    """
+    Tests that leaves processed side by side with different configs each match processing
+    with the module settings changed accordingly, and that configs are immutable and hashable.
+    """
+    config = PipelineConfig.from_settings(leaflesiondetector.lesion_detector.settings)
+    mask_config = dataclasses.replace(config, leaf_segmentation="mask")
+    assert config == PipelineConfig.from_settings(load_settings())
+    assert len({config, mask_config, PipelineConfig.from_settings()}) == 2
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.tile_rows = 64
+
+    leaves = [Leaf(name, name, base_leaf.img) for name in ("contour", "mask")]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(process_leaf, leaves, [None, None], [config, mask_config]))
+
+    for leaf_segmentation, leaf in zip(["contour", "mask"], leaves):
+        monkeypatch.setitem(
+            leaflesiondetector.lesion_detector.settings,
+            "leaf_segmentation",
+            leaf_segmentation,
+        )
+        expected_leaf = Leaf("expected", "expected", base_leaf.img)
+        process_leaf(expected_leaf)
+        assert leaf.leaf_area == expected_leaf.leaf_area
+        assert leaf.lesion_class_map == expected_leaf.lesion_class_map
+
+    cache = ResultCache(tmp_path, 1)
+    assert cache.key(leaves[0], config) != cache.key(leaves[0], mask_config)
+    assert cache.key(leaves[0], config) == cache.key(
+        leaves[0], dataclasses.replace(config, tile_rows=64)
+    )
+
+
+# Unit test for the config built from the module settings
+def test_module_settings_config_is_built_once(base_leaf, monkeypatch):
+    """
+    Tests that the config built from the module settings is reused until a setting changes,
+    and that a leaf keeps the config it was processed with.
+    """
+    settings = leaflesiondetector.lesion_detector.settings
+    config = settings.config()
+    assert settings.config() is config
+    process_leaf(base_leaf)
+    assert base_leaf.config is config
+
+    monkeypatch.setitem(settings, "leaf_segmentation", "mask")
+    assert settings.config() is not config
+    assert settings.config().leaf_segmentation == "mask"
+    base_leaf.lesion_size_threshold = 50.0
+    process_image(base_leaf)
+    assert base_leaf.config is config
+
+
+# Integration test for the batch command line interface
+def test_cli_writes_results_csv(tmp_path):
+    """
+    Tests that the command line interface processes a folder of images
+    and writes a results row for each of them.
+    """
+    input_path = tmp_path / "input_images"
+    input_path.mkdir()
+    with Image.open("./tests/fixtures/input_images/Xg_01_post.jpeg") as img:
+        img.save(input_path / "Xg_01_post.jpeg")
+
+    cli.main(
+        [
+            str(input_path),
+            "--output",
+            str(tmp_path),
+            "--workers",
+            "1",
+            "--cache",
+            str(tmp_path / "cache"),
+            "--store",
+            str(tmp_path / "results.sqlite"),
+        ]
+    )
+
+    with open(tmp_path / "results.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["Image"] for row in rows] == ["Xg_01_post.jpeg"]
+    assert float(rows[0]["Percentage area"]) > 0
+    assert len(list((tmp_path / "cache").glob("*.npz"))) > 0
+    assert ResultsStore(tmp_path / "results.sqlite").disease_summary()[0]["count"] == 1
+
+
+# Integration test for the batch command line interface with a failing image
+def test_cli_continues_after_failed_image(tmp_path, capsys):
+    """
+    Tests that an image which fails to process is reported and the rest of
+    the batch is still processed and saved.
+    """
+    input_path = tmp_path / "input_images"
+    input_path.mkdir()
+    Image.new("RGB", (1, 1)).save(input_path / "Xg_00_post.png")
+    with Image.open("./tests/fixtures/input_images/Xg_01_post.jpeg") as img:
+        img.save(input_path / "Xg_01_post.jpeg")
+
+    cli.main(
+        [
+            str(input_path),
+            "--output",
+            str(tmp_path),
+            "--workers",
+            "1",
+            "--no-cache",
+            "--store",
+            str(tmp_path / "results.sqlite"),
+        ]
+    )
+
+    assert "Xg_00_post.png: could not be processed" in capsys.readouterr().err
+    with open(tmp_path / "results.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["Image"] for row in rows] == ["Xg_01_post.jpeg"]
+    assert ResultsStore(tmp_path / "results.sqlite").disease_summary()[0]["count"] == 1